@@ -0,0 +1,207 @@
+import threading
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+import functools
+
+from MocneBoty.Stats import Counter, stats
+
+
+class Admission(Enum):
+    STARTED = "started"  # slot taken, caller starts the schedule right away
+    QUEUED = "queued"  # waits for a free global slot, controller calls start() when it gets one
+    REJECTED = "rejected"
+
+
+@dataclass
+class ScheduleLimits:
+    """
+    Task limits are per task name ("Regular", "Webcam"), task missing in the dict = no limit of that kind
+    """
+    per_chat: Dict[str, int] = field(default_factory=lambda: {"Regular": 1, "Webcam": 1})
+    per_chat_total: int = 3  # running + queued schedules of one chat
+    global_limits: Dict[str, int] = field(default_factory=lambda: {"Webcam": 4})  # cameras/inference cpu
+    global_total: int = 10000
+    queue_per_chat: int = 1  # schedules of one chat waiting for global slot, 0 = reject right away when full
+    queue_total: int = 100
+
+
+@dataclass
+class _Waiting:
+    thread_id: int
+    chat_id: int
+    task_name: str
+    start: Callable[[], None]
+
+
+@dataclass
+class AdmissionController:
+    """
+    Per chat and global concurrency limits for schedules. Over per chat limit = rejected (chat has to stop
+    something of its own), global limit full = queued. Freed slot goes to waiting chats round robin,
+    so one chat with a queued schedule can't get in line before everyone else
+    """
+    limits: ScheduleLimits = field(default_factory=ScheduleLimits)
+    _running: Dict[int, Tuple[int, str]] = field(init=False, default_factory=dict)  # thread id -> (chat, task)
+    _global_counts: Dict[str, int] = field(init=False, default_factory=lambda: defaultdict(int))
+    _chat_counts: Dict[int, Dict[str, int]] = field(init=False, default_factory=dict)  # running + waiting
+    _waiting: Dict[int, Deque[_Waiting]] = field(init=False, default_factory=dict)  # chat -> its queue
+    _waiting_chats: Deque[int] = field(init=False, default_factory=deque)  # round robin order
+    _waiting_ids: Dict[int, _Waiting] = field(init=False, default_factory=dict)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _results: Dict[str, Counter] = field(init=False)
+
+    def __post_init__(self) -> None:
+        # looked up once, admit runs for every restored schedule at start
+        self._results = {result: stats.counter("admission_total", result=result)
+                         for result in ("started", "queued", "rejected_chat", "rejected_full")}
+
+    def admit(self, thread_id: int, chat_id: int, task_name: str, start: Callable[[], None],
+              restored: bool = False) -> Tuple[Admission, str]:
+        """
+        :param start: starts the schedule, called later by release() if it gets queued
+        :param restored: schedule from before restart, it was admitted once so only global limits apply
+        (and it's always queued rather than rejected)
+        :return: verdict and message for the user (empty when started)
+        """
+        limits = self.limits
+        with self._lock:
+            chat_counts = self._chat_counts.get(chat_id, {})
+            task_limit = limits.per_chat.get(task_name)
+            if not restored and task_limit is not None and chat_counts.get(task_name, 0) >= task_limit:
+                self._results["rejected_chat"].inc()
+                return Admission.REJECTED, f"You can only run {task_limit} {task_name.lower()} schedule(s) at " \
+                                           f"once. Stop one of them (/listThreads, /stopThread) to make a new one."
+            if not restored and sum(chat_counts.values()) >= limits.per_chat_total:
+                self._results["rejected_chat"].inc()
+                return Admission.REJECTED, f"You can only have {limits.per_chat_total} schedules at once. " \
+                                           f"Stop one of them (/listThreads, /stopThread) to make a new one."
+
+            if self._fits(task_name):
+                self._take(thread_id, chat_id, task_name)
+                self._results["started"].inc()
+                return Admission.STARTED, ""
+
+            chat_queue = self._waiting.get(chat_id, ())
+            if not restored and (len(chat_queue) >= limits.queue_per_chat or
+                                 len(self._waiting_ids) >= limits.queue_total):
+                self._results["rejected_full"].inc()
+                return Admission.REJECTED, f"Bot is busy right now, all {task_name.lower()} slots are taken. " \
+                                           f"Try again later."
+
+            self._add_waiting(_Waiting(thread_id=thread_id, chat_id=chat_id, task_name=task_name, start=start))
+            self._results["queued"].inc()
+            return Admission.QUEUED, f"All {task_name.lower()} slots are taken, schedule {thread_id} is queued " \
+                                     f"({len(self._waiting_ids)} waiting) and starts by itself when one frees up."
+
+    def admit_restored(self, schedules: List[Tuple[int, int, str]], start: Callable[[int], None]) -> List[int]:
+        """
+        admit(..., restored=True) for all schedules brought back at start, under one lock
+        :param schedules: (thread_id, chat_id, task_name)
+        :param start: called with thread id of queued schedule when it gets its slot
+        :return: ids of schedules that got slot right away, caller starts them
+        """
+        started = []
+        with self._lock:
+            for thread_id, chat_id, task_name in schedules:
+                if self._fits(task_name):
+                    self._take(thread_id, chat_id, task_name)
+                    started.append(thread_id)
+                else:
+                    self._add_waiting(_Waiting(thread_id=thread_id, chat_id=chat_id, task_name=task_name,
+                                               start=functools.partial(start, thread_id)))
+        self._results["started"].inc(len(started))
+        self._results["queued"].inc(len(schedules) - len(started))
+        return started
+
+    def release(self, thread_id: int) -> None:
+        """
+        Schedule is done (or stopped while waiting), freed slot goes to the next waiting schedule that fits
+        """
+        to_start = []
+        with self._lock:
+            waiting = self._waiting_ids.pop(thread_id, None)
+            if waiting is not None:
+                chat_queue = self._waiting[waiting.chat_id]
+                chat_queue.remove(waiting)
+                if not chat_queue:
+                    del self._waiting[waiting.chat_id]
+                    self._waiting_chats.remove(waiting.chat_id)
+                self._count(waiting.chat_id, waiting.task_name, -1)
+                return
+
+            running = self._running.pop(thread_id, None)
+            if running is None:
+                return
+            chat_id, task_name = running
+            self._global_counts[task_name] -= 1
+            self._count(chat_id, task_name, -1)
+
+            while True:
+                waiting = self._next_waiting()
+                if waiting is None:
+                    break
+                # counted in _chat_counts since admit, only global slot is taken here
+                self._running[waiting.thread_id] = (waiting.chat_id, waiting.task_name)
+                self._global_counts[waiting.task_name] += 1
+                to_start.append(waiting)
+
+        # outside of the lock, start may take other locks (registry, scheduler)
+        for waiting in to_start:
+            waiting.start()
+
+    def is_waiting(self, thread_id: int) -> bool:
+        return thread_id in self._waiting_ids
+
+    def report(self) -> str:
+        with self._lock:
+            running = ", ".join(f"{task}={count}" for task, count in sorted(self._global_counts.items()) if count)
+            return f"Admission: running {len(self._running)} ({running or '-'}), waiting {len(self._waiting_ids)} " \
+                   f"in {len(self._waiting)} chats"
+
+    def _fits(self, task_name: str) -> bool:
+        # must be called with self._lock held
+        task_limit = self.limits.global_limits.get(task_name)
+        if task_limit is not None and self._global_counts[task_name] >= task_limit:
+            return False
+        return len(self._running) < self.limits.global_total
+
+    def _add_waiting(self, waiting: _Waiting) -> None:
+        if waiting.chat_id not in self._waiting:
+            self._waiting[waiting.chat_id] = deque()
+            self._waiting_chats.append(waiting.chat_id)
+        self._waiting[waiting.chat_id].append(waiting)
+        self._waiting_ids[waiting.thread_id] = waiting
+        self._count(waiting.chat_id, waiting.task_name, 1)
+
+    def _take(self, thread_id: int, chat_id: int, task_name: str) -> None:
+        self._running[thread_id] = (chat_id, task_name)
+        self._global_counts[task_name] += 1
+        self._count(chat_id, task_name, 1)
+
+    def _count(self, chat_id: int, task_name: str, diff: int) -> None:
+        chat_counts = self._chat_counts.setdefault(chat_id, {})
+        chat_counts[task_name] = chat_counts.get(task_name, 0) + diff
+        if not chat_counts[task_name]:
+            del chat_counts[task_name]
+        if not chat_counts:
+            del self._chat_counts[chat_id]
+
+    def _next_waiting(self) -> Optional[_Waiting]:
+        """
+        First chat in round robin order whose oldest waiting schedule fits now, chat goes to the end of the line
+        """
+        for ind, chat_id in enumerate(self._waiting_chats):
+            chat_queue = self._waiting[chat_id]
+            if not self._fits(chat_queue[0].task_name):
+                continue
+            del self._waiting_chats[ind]
+            waiting = chat_queue.popleft()
+            del self._waiting_ids[waiting.thread_id]
+            if chat_queue:
+                self._waiting_chats.append(chat_id)
+            else:
+                del self._waiting[chat_id]
+            return waiting
+        return None
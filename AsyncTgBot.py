@@ -0,0 +1,372 @@
+from typing import Any, Dict, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import asyncio
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import Message, CallbackQuery
+
+from MocneBoty.Admission import Admission
+from MocneBoty.BotLogger import bot_logger, log_ids
+from MocneBoty.PresenceLog import PresenceRecorder, PresenceStore
+from MocneBoty.Stats import MetricsServer, stats
+from MocneBoty.TgBot import ThreadsHandler, ScheduleEntry, ALL_COMMANDS_STR, parse_schedule_params, \
+    start_menu_markup, threads_menu_markup
+
+
+@dataclass
+class LoopSender:
+    """
+    Sync send_message for code running outside of the event loop (webcam executor threads)
+    """
+    bot: AsyncTeleBot
+    loop: asyncio.AbstractEventLoop
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> None:
+        try:
+            asyncio.run_coroutine_threadsafe(self.bot.send_message(chat_id, text, **kwargs), self.loop).result()
+        except Exception as e:
+            # same as sync bot's outbox, failed notification doesn't stop the webcam loop
+            bot_logger.error(f"[LoopSender - {chat_id}] send failed: {e}", extra=log_ids(chat_id))
+
+    def send_photo(self, chat_id: int, photo: Any, **kwargs) -> None:
+        """
+        Doesn't wait for the result, it's called from snapshot callbacks which mustn't block the webcam loop
+        """
+        def log_error(future):
+            if future.exception() is not None:
+                bot_logger.error(f"[LoopSender - {chat_id}] send_photo failed: {future.exception()}",
+                                 extra=log_ids(chat_id))
+
+        asyncio.run_coroutine_threadsafe(self.bot.send_photo(chat_id, photo, **kwargs), self.loop) \
+            .add_done_callback(log_error)
+
+
+@dataclass
+class AsyncTelegramBot(ThreadsHandler):
+    """
+    asyncio version of TelegramBot, regular schedules are just tasks sleeping in the event loop so there is no
+    thread per schedule, webcam schedules are offloaded to a thread pool
+    """
+    bot_token: str = ""
+    webcam_workers: int = 4
+    admin_chat_ids: Tuple[int, ...] = ()  # chats allowed to use /stats
+    metrics_port: int = 0  # > 0 = prometheus metrics on http://127.0.0.1:<port>/metrics
+    presence_path: str = "presence.db"  # webcam presence history for /report, empty string = not recorded
+    _tasks: Dict[int, asyncio.Task] = field(default_factory=dict)
+    _webcams: Dict[int, Any] = field(init=False, default_factory=dict)  # thread id -> running WorkScheduleWebcam
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def __post_init__(self) -> None:
+        super().__post_init__()
+        self.bot = AsyncTeleBot(self.bot_token)
+        self._executor = ThreadPoolExecutor(max_workers=self.webcam_workers, thread_name_prefix="webcam")
+        self.presence_store = PresenceStore(db_path=self.presence_path) if self.presence_path else None
+
+    def presence_report(self, chat_id: int, period: str = "day") -> str:
+        if self.presence_store is None:
+            return "Presence is not recorded on this bot"
+        return self.presence_store.report(chat_id, period)
+
+    def stop_thread(self, thread_id: int, chat_id: Optional[int] = None) -> bool:
+        success = super().stop_thread(thread_id=thread_id, chat_id=chat_id)
+        task = self._tasks.pop(thread_id, None) if success else None
+        if task is not None:
+            # can be called from executor threads as well
+            self._loop.call_soon_threadsafe(task.cancel)
+        return success
+
+    @staticmethod
+    async def _sleep(seconds: float) -> None:
+        """
+        asyncio.sleep that reports how late it woke up, same metric as TimerScheduler's
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + seconds
+        await asyncio.sleep(seconds)
+        stats.observe("timer_lateness_seconds", max(0.0, loop.time() - deadline), scheduler="asyncio")
+
+    def start_schedule(self, coro_func, entry: ScheduleEntry) -> None:
+        task = asyncio.create_task(coro_func(entry), name=entry.data.name)
+        task.add_done_callback(self._task_done)
+        self._tasks[entry.thread_id] = task
+        bot_logger.info(f"[Create task - {entry.chat_id}] thread: {entry.thread_id} started",
+                        extra=log_ids(entry.chat_id, entry.thread_id))
+
+    def create_schedule(self, coro_func, work_time: int, break_time: int, repeat: int, chat_id: int,
+                        task_name: str) -> Tuple[Admission, str]:
+        """
+        Goes through admission like TelegramBot.create_thread, queued schedule is started from whichever thread
+        frees its slot, so the task is always created through the loop
+        """
+        return self.admit_thread(lambda entry: self._loop.call_soon_threadsafe(self.start_schedule, coro_func, entry),
+                                 work_time=work_time, break_time=break_time, chat_id=chat_id, task_name=task_name,
+                                 repeat=repeat)
+
+    @staticmethod
+    def _task_done(task: asyncio.Task) -> None:
+        # nobody awaits schedule tasks, without this their exceptions would only show up at gc
+        if not task.cancelled() and task.exception() is not None:
+            bot_logger.error(f"[Task {task.get_name()}] failed: {task.exception()!r}")
+
+    async def _notify(self, chat_id: int, text: str) -> None:
+        """
+        send_message that only logs errors (bot blocked, network, 429), schedule goes on without the message
+        """
+        try:
+            await self.bot.send_message(chat_id, text)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            bot_logger.error(f"[Notify - {chat_id}] send failed: {e}", extra=log_ids(chat_id))
+
+    async def regular_schedule(self, entry: ScheduleEntry) -> None:
+        thread_id, chat_id = entry.thread_id, entry.chat_id
+        work_time, break_time, repeat = entry.data.work_time, entry.data.break_time, entry.data.repeat
+        call_params = f"{thread_id=}, {work_time=}, {break_time=}, {repeat=}"
+        bot_logger.info(f"[Regular Scheduler - {chat_id}] start: {call_params}", extra=log_ids(chat_id, thread_id))
+
+        cancelled = False
+        try:
+            await self._notify(chat_id, f"Let's start work")
+            while entry.repeat_count < repeat or not repeat:
+                entry.phase = "work"
+                await self._sleep(work_time)
+                await self._notify(chat_id, f"{entry.repeat_count+1}/{repeat} work finished, time for a break!")
+                bot_logger.info(f"[Regular Scheduler - {chat_id}] work time finished {entry.repeat_count+1}/{repeat}: "
+                                f"{call_params}", extra=log_ids(chat_id, thread_id))
+
+                entry.phase = "break"
+                await self._sleep(break_time)
+                if entry.repeat_count < repeat-1 or not repeat:
+                    await self._notify(chat_id, f"{entry.repeat_count+1}/{repeat} break finished, "
+                                                f"it's time to get back to work :/")
+                    bot_logger.info(f"[Regular Scheduler - {chat_id}] break time finished "
+                                    f"{entry.repeat_count+1}/{repeat}: {call_params}",
+                                    extra=log_ids(chat_id, thread_id))
+                entry.repeat_count += 1
+        except asyncio.CancelledError:
+            cancelled = True
+        finally:
+            # also when something failed, registry entry and admission slot must not stay behind.
+            # Task is forgotten first, otherwise stop_thread would cancel this very coroutine
+            self._tasks.pop(thread_id, None)
+            self.stop_thread(thread_id=thread_id)
+
+        await self._notify(chat_id, f"Thread {thread_id} (regular schedule) has been finished")
+        bot_logger.info(f"[Regular Scheduler - {chat_id}] stop: {call_params}", extra=log_ids(chat_id, thread_id))
+        if cancelled:
+            raise asyncio.CancelledError()
+
+    def _run_webcam(self, entry: ScheduleEntry) -> None:
+        # same as TgBot, vision stack is loaded only when a webcam schedule really runs
+        from MocneBoty.WorkScheduleWebcam import WorkScheduleWebcam, DetectionPolicy
+
+        wsw = WorkScheduleWebcam(
+            max_faces=1,
+            device_id=0,
+            work_time=entry.data.work_time,
+            break_time=entry.data.break_time,
+            repeat=entry.data.repeat,
+            policy=DetectionPolicy.presence_only(),
+            shared=True
+        )
+        presence = PresenceRecorder(store=self.presence_store, chat_id=entry.chat_id, schedule_id=entry.thread_id) \
+            if self.presence_store is not None else None
+        self._webcams[entry.thread_id] = wsw
+        try:
+            wsw.run(bot=LoopSender(bot=self.bot, loop=self._loop), chat_id=entry.chat_id,
+                    stop_event=entry.cancel_event, presence=presence)
+        finally:
+            self._webcams.pop(entry.thread_id, None)
+            if presence is not None:
+                presence.close()
+
+    async def webcam_schedule(self, entry: ScheduleEntry) -> None:
+        thread_id, chat_id = entry.thread_id, entry.chat_id
+        call_params = f"{thread_id=}, work_time={entry.data.work_time}, break_time={entry.data.break_time}, " \
+                      f"repeat={entry.data.repeat}"
+        bot_logger.info(f"[Webcam Scheduler - {chat_id}] start: {call_params}", extra=log_ids(chat_id, thread_id))
+
+        cancelled = False
+        try:
+            # cancelling this await doesn't stop the executor job, the cancel event set by stop_thread does
+            await self._loop.run_in_executor(self._executor, self._run_webcam, entry)
+        except asyncio.CancelledError:
+            cancelled = True
+        except Exception as e:
+            # no camera, vision stack missing...
+            await self._notify(chat_id, f"Something went wrong: {e}")
+            bot_logger.error(f"[Webcam Scheduler - {chat_id}] {call_params}, error: {e}",
+                             extra=log_ids(chat_id, thread_id))
+        finally:
+            self._tasks.pop(thread_id, None)
+            self.stop_thread(thread_id=thread_id)
+
+        await self._notify(chat_id, f"Thread {thread_id} (webcam schedule) has been finished")
+        bot_logger.info(f"[Webcam Scheduler - {chat_id}] stopped: {call_params}", extra=log_ids(chat_id, thread_id))
+        if cancelled:
+            raise asyncio.CancelledError()
+
+    def setup_handlers(self) -> None:
+        @self.bot.message_handler(commands=["start"])
+        @stats.timed("handler_seconds", command="start")
+        async def start_command(message: Message):
+            await self.bot.send_message(message.chat.id,
+                                        "<strong>Turbo menu</strong>",
+                                        reply_markup=start_menu_markup(),
+                                        parse_mode="html")
+
+        @self.bot.message_handler(commands=["webcam"])
+        @stats.timed("handler_seconds", command="webcam")
+        async def webcam_sched_command(message: Message):
+            bot_logger.info(f"[webcam_sched_command - {message.chat.id}] params raw: {message.text.split()[1:]}",
+                            extra=log_ids(chat_id=message.chat.id))
+            params, error = parse_schedule_params(message.text)
+            if error:
+                await self.bot.send_message(message.chat.id, error)
+
+            if params:
+                work_time, break_time, repeat = params
+                try:
+                    _, reply = self.create_schedule(self.webcam_schedule, work_time=work_time, break_time=break_time,
+                                                    repeat=repeat, chat_id=message.chat.id, task_name="Webcam")
+                    await self.bot.send_message(message.chat.id, reply or f"Started")
+                except Exception as e:
+                    await self.bot.send_message(message.chat.id, f"Something went wrong: {e}")
+                    bot_logger.error(f"[webcam_sched_command - {message.chat.id}] params: {params}, error: {e}",
+                                     extra=log_ids(chat_id=message.chat.id))
+
+        @self.bot.message_handler(commands=["regular"])
+        @stats.timed("handler_seconds", command="regular")
+        async def regular_sched_command(message: Message):
+            bot_logger.info(f"[regular_sched_command - {message.chat.id}] params raw: {message.text.split()[1:]}",
+                            extra=log_ids(chat_id=message.chat.id))
+            params, error = parse_schedule_params(message.text)
+            if error:
+                await self.bot.send_message(message.chat.id, error)
+
+            if params:
+                work_time, break_time, repeat = params
+                try:
+                    _, reply = self.create_schedule(self.regular_schedule, work_time=work_time, break_time=break_time,
+                                                    repeat=repeat, chat_id=message.chat.id, task_name="Regular")
+                    await self.bot.send_message(message.chat.id, reply or f"Started")
+                except Exception as e:
+                    bot_logger.error(f"[regular_sched_command - {message.chat.id}] params: {params}, error: {e}",
+                                     extra=log_ids(chat_id=message.chat.id))
+                    await self.bot.send_message(message.chat.id, f"Something went wrong: {e}")
+
+        @self.bot.message_handler(commands=["stopThread"])
+        @stats.timed("handler_seconds", command="stopThread")
+        async def stop_thread_command(message: Message):
+            splitted = message.text.split()
+            bot_logger.info(f"[stopThread command - {message.chat.id}] params: {splitted}",
+                            extra=log_ids(chat_id=message.chat.id))
+
+            if len(splitted) != 2:
+                await self.bot.send_message(message.chat.id, f"This command takes 1 argument")
+            elif not splitted[1].isdigit():
+                await self.bot.send_message(message.chat.id, f"Thread id must be a digit")
+            else:
+                thread_id = int(splitted[1])
+                if self.stop_thread(thread_id=thread_id, chat_id=message.chat.id):
+                    await self.bot.send_message(message.chat.id, f"Thread: {thread_id} has been stopped")
+                    bot_logger.info(f"[stopThread command - {message.chat.id}] Thread: {thread_id} has been stopped",
+                                    extra=log_ids(chat_id=message.chat.id, schedule_id=thread_id))
+                else:
+                    await self.bot.send_message(message.chat.id, f"Thread: {thread_id} was not stopped successfully")
+                    bot_logger.error(f"[stopThread command - {message.chat.id}] Thread: {thread_id} "
+                                     f"was not stopped successfully",
+                                     extra=log_ids(chat_id=message.chat.id, schedule_id=thread_id))
+
+        @self.bot.message_handler(commands=["listThreads"])
+        @stats.timed("handler_seconds", command="listThreads")
+        async def list_threads_command(message: Message):
+            await self.bot.send_message(message.chat.id, self.list_threads(chat_id=message.chat.id))
+
+        @self.bot.message_handler(commands=["snapshot"])
+        @stats.timed("handler_seconds", command="snapshot")
+        async def snapshot_command(message: Message):
+            # /snapshot = every running webcam schedule of the chat, /snapshot <thrId> = only that one
+            chat_id = message.chat.id
+            params = message.text.split()[1:]
+            webcams = [(entry.thread_id, self._webcams.get(entry.thread_id)) for entry in self.chat_threads(chat_id)
+                       if not params or str(entry.thread_id) == params[0]]
+            webcams = [(thread_id, wsw) for thread_id, wsw in webcams if wsw is not None]
+            if not webcams:
+                await self.bot.send_message(chat_id, "No running webcam schedule")
+                return
+
+            sender = LoopSender(bot=self.bot, loop=self._loop)
+            for thread_id, wsw in webcams:
+                # rendered by the webcam loop with its next frame, sent from there
+                wsw.request_snapshot(lambda jpeg, thread_id=thread_id:
+                                     sender.send_photo(chat_id, jpeg, caption=f"Thread {thread_id}"))
+
+        @self.bot.message_handler(commands=["report"])
+        @stats.timed("handler_seconds", command="report")
+        async def report_command(message: Message):
+            params = message.text.split()[1:]
+            period = params[0] if params else "day"
+            if len(params) > 1 or period not in ("day", "week"):
+                await self.bot.send_message(message.chat.id, "Usage: /report [day|week]")
+                return
+            # sqlite read, kept off the event loop
+            report = await self._loop.run_in_executor(None, self.presence_report, message.chat.id, period)
+            await self.bot.send_message(message.chat.id, report)
+
+        @self.bot.message_handler(commands=["stats"])
+        @stats.timed("handler_seconds", command="stats")
+        async def stats_command(message: Message):
+            if message.chat.id not in self.admin_chat_ids:
+                await self.bot.send_message(message.chat.id, "This command is only for bot admins")
+                return
+            await self.bot.send_message(message.chat.id, self.stats_report())
+
+        @self.bot.callback_query_handler(func=lambda call: True)
+        @stats.timed("handler_seconds", command="callback")
+        async def answer(callback: CallbackQuery):
+            if not callback.message:
+                return
+            chat_id = callback.message.chat.id
+
+            if callback.data == "webcam":
+                await self.bot.send_message(chat_id, "run /webcam <workTimeSecs> <breakTimeSecs> <Repeat>")
+            elif callback.data == "regular":
+                await self.bot.send_message(chat_id, "run /regular <workTimeSecs> <breakTimeSecs> <Repeat>")
+            elif callback.data == "threads":
+                await self.bot.edit_message_text(chat_id=chat_id, message_id=callback.message.message_id,
+                                                 text="<strong>Threads menu</strong>",
+                                                 reply_markup=threads_menu_markup(), parse_mode="html")
+            elif callback.data == "list_threads":
+                await self.bot.send_message(chat_id, self.list_threads(chat_id=chat_id))
+                await self.bot.send_message(chat_id, "run /listThreads")
+            elif callback.data == "kill_thread":
+                await self.bot.send_message(chat_id, "run /stopThread <thrId>")
+            elif callback.data == "all_commands":
+                await self.bot.send_message(chat_id, ALL_COMMANDS_STR)
+
+    async def _main(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self.setup_handlers()
+        bot_logger.info("Handlers ready, should be all green :P")
+        if self.metrics_port:
+            MetricsServer(registry=stats, port=self.metrics_port).start()
+        try:
+            await self.bot.polling(non_stop=True)
+        finally:
+            for thread_id in list(self._threads_status):
+                self.stop_thread(thread_id=thread_id)
+            self._executor.shutdown(wait=False)
+            if self.presence_store is not None:
+                self.presence_store.stop()
+
+    def start(self) -> None:
+        bot_logger.info("Starting (asyncio mode)")
+        asyncio.run(self._main())
+
+
+if __name__ == '__main__':
+    # same as TgBot.py, token goes here
+    bot = AsyncTelegramBot(bot_token="")
+    bot.start()
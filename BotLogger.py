@@ -1,5 +1,106 @@
+import atexit
+import json
 import logging
+import queue
+import sys
 from dataclasses import dataclass
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from time import time
+from typing import Any, Dict, Optional
+
+
+class SizeTimeRotatingFileHandler(RotatingFileHandler):
+    """
+    Rotates when file gets bigger than max_bytes or every interval seconds, whichever comes first
+    (0 turns given trigger off), old files are bot_logs.log.1 ... .backup_count
+    """
+    def __init__(self, filename: str, max_bytes: int = 0, interval: float = 0, backup_count: int = 5,
+                 batched: bool = False) -> None:
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+        self.interval = interval
+        self.rollover_at = time() + interval if interval else 0
+        self.batched = batched
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.interval and time() >= self.rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time() + self.interval
+
+    def flush(self) -> None:
+        # batched = listener calls flush_batch once per batch instead of flushing after every record
+        if not self.batched:
+            super().flush()
+
+    def flush_batch(self) -> None:
+        super().flush()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One json object per line, chat_id/schedule_id come from extra (see log_ids)
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        data = {"time": record.created, "level": record.levelname, "logger": record.name, "line": record.lineno,
+                "thread": record.threadName, "message": record.getMessage()}
+        for key in ("chat_id", "schedule_id"):
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class LockFreeQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # queue never leaves the process, formatting (and copying the record) is left to the listener thread
+        return record
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # SimpleQueue.put is thread safe on its own, default handle() would make every thread wait on handler lock
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+
+class BatchingQueueListener(QueueListener):
+    """
+    Takes everything waiting in the queue at once, writes it and flushes the file once per batch
+    """
+    def __init__(self, log_queue: queue.SimpleQueue, *handlers: logging.Handler, max_batch: int = 512) -> None:
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.max_batch = max_batch
+
+    def _monitor(self) -> None:
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            for record in batch:
+                if record is self._sentinel:
+                    running = False
+                    continue
+                self.handle(record)
+            for handler in self.handlers:
+                getattr(handler, "flush_batch", handler.flush)()
+
+
+def log_ids(chat_id: Optional[int] = None, schedule_id: Optional[int] = None) -> Dict[str, Any]:
+    """
+    extra for log calls, e.g. bot_logger.info("...", extra=log_ids(chat_id, thread_id)), they end up as json fields
+    """
+    return {"chat_id": chat_id, "schedule_id": schedule_id}
 
 
 @dataclass
@@ -10,23 +111,60 @@ class CustomLogger:
     logger_name: str = __name__
     logger_log_level: int = logging.ERROR
     file_handler_log_level: int = logging.ERROR
+    async_mode: bool = False  # log calls only put record on a queue, listener thread does the writing
+    json_lines: bool = False
+    max_bytes: int = 0  # rotate when file is bigger than that, 0 = never
+    rotate_interval: float = 0  # rotate every n seconds (e.g. 86400), 0 = never
+    backup_count: int = 5
+    _listener: Optional[QueueListener] = None
 
     def create_logger(self) -> logging.Logger:
-        logging.basicConfig(format=self.format)
         logger = logging.getLogger(self.logger_name)
         logger.setLevel(self.logger_log_level)
+        # can be called again with different settings, handlers of the previous call go away
+        self.shutdown()
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
 
-        file_handler = logging.FileHandler(self.log_file_name)
-        file_handler.setLevel(self.logger_log_level)
+        file_handler = SizeTimeRotatingFileHandler(self.log_file_name, max_bytes=self.max_bytes,
+                                                   interval=self.rotate_interval, backup_count=self.backup_count,
+                                                   batched=self.async_mode)
+        file_handler.setLevel(self.file_handler_log_level)
+        file_handler.setFormatter(JsonFormatter() if self.json_lines else self.file_handler_format)
 
-        file_handler.setFormatter(self.file_handler_format)
-        logger.addHandler(file_handler)
+        if not self.async_mode:
+            logging.basicConfig(format=self.format)
+            logger.propagate = True
+            logger.addHandler(file_handler)
+            return logger
 
+        # console output goes through the listener too, otherwise root handler would write synchronously
+        console_handler = logging.StreamHandler(sys.stderr)
+        console_handler.setFormatter(logging.Formatter(self.format))
+        log_queue = queue.SimpleQueue()
+        self._listener = BatchingQueueListener(log_queue, file_handler, console_handler)
+        self._listener.start()
+        atexit.register(self.shutdown)
+
+        logger.propagate = False
+        logger.addHandler(LockFreeQueueHandler(log_queue))
         return logger
 
+    def shutdown(self) -> None:
+        """
+        Writes whatever is still queued (async mode), called at exit as well
+        """
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            listener.stop()
+
 
 custom_logger = CustomLogger(logger_log_level=logging.INFO,
                              file_handler_log_level=logging.INFO,
                              log_file_name=f"bot_logs.log",
-                             logger_name="Bot")
+                             logger_name="Bot",
+                             async_mode=True,
+                             max_bytes=10 * 1024 * 1024,
+                             backup_count=5)
 bot_logger = custom_logger.create_logger()
@@ -0,0 +1,214 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+import threading
+import numpy as np
+import cv2
+
+from MocneBoty.BotLogger import bot_logger
+from MocneBoty.FrameGrabber import CaptureFormat, FrameGrabber
+from MocneBoty.InferenceWorkers import InferencePool
+from MocneBoty.Stats import stats
+from MocneBoty.WorkScheduleWebcam import FaceDetector, DetectionPolicy, PresenceSampler
+
+
+@dataclass
+class SharedCamera:
+    """
+    One opened device + one detector, detection runs once per frame and every subscribed schedule gets
+    the same result
+    """
+    device_id: int
+    cap: cv2.VideoCapture
+    detector: Optional[FaceDetector]
+    policy: DetectionPolicy
+    inference_pool: Optional[InferencePool] = None  # if set inference goes there and detector isn't used
+    subscribers: int = 0
+    _grabber: FrameGrabber = field(init=False)
+    _cond: threading.Condition = field(init=False, default_factory=threading.Condition)
+    _buffers: List[Optional[np.ndarray]] = field(init=False, default_factory=lambda: [None, None])
+    _frame: Optional[np.ndarray] = field(init=False, default=None)
+    _boxes: np.ndarray = field(init=False, default_factory=lambda: np.empty((0, 4), dtype=np.int32))
+    _seq: int = field(init=False, default=0)
+    _timestamp: float = field(init=False, default=0)
+    _running: bool = field(init=False, default=False)
+    _thread: Optional[threading.Thread] = field(init=False, default=None)
+
+    def __post_init__(self) -> None:
+        self._grabber = FrameGrabber(cap=self.cap, name=f"FrameGrabber-{self.device_id}")
+
+    def start(self) -> None:
+        self._running = True
+        self._grabber.start()
+        self._thread = threading.Thread(target=self._detect_loop, name=f"SharedCamera-{self.device_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._grabber.stop()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.cap.release()
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def _detect_loop(self) -> None:
+        sampler = PresenceSampler(policy=self.policy)
+        seq, ind = 0, 0
+        inference_time = stats.histogram("webcam_stage_seconds", stage="inference")
+
+        def detect(img: np.ndarray) -> np.ndarray:
+            with inference_time.time():
+                if self.inference_pool is not None:
+                    return self.inference_pool.get_boxes(img, model=self.policy.presence_model,
+                                                         inference_width=self.policy.inference_width)
+                return self.detector.get_boxes(img, model=self.policy.presence_model,
+                                               inference_width=self.policy.inference_width)
+
+        try:
+            while self._running:
+                # two buffers: one is published, the other one is filled, subscribers copy under self._cond
+                frame, seq, timestamp = self._grabber.read(self._buffers[ind], last_seq=seq, timeout=1.0)
+                if frame is None:
+                    if self._grabber.running:
+                        continue
+                    break
+                self._buffers[ind] = frame
+                boxes = sampler.update(frame, timestamp, detect)
+
+                with self._cond:
+                    self._frame, self._boxes, self._timestamp = frame, boxes, timestamp
+                    self._seq += 1
+                    self._cond.notify_all()
+                ind = 1 - ind
+        except Exception as e:
+            # e.g. inference worker died, subscribers must not wait forever for the next frame
+            bot_logger.error(f"[SharedCamera - {self.device_id}] detection failed: {e}")
+        finally:
+            bot_logger.info(f"[SharedCamera - {self.device_id}] detection stopped")
+            with self._cond:
+                self._running = False
+                self._cond.notify_all()
+
+    def get(self, out: Optional[np.ndarray], last_seq: int = 0,
+            timeout: Optional[float] = None) -> Tuple[Optional[np.ndarray], int, float, np.ndarray]:
+        """
+        Waits for result newer than last_seq, frame is copied to out (reused if shape matches)
+        :return: (frame, seq, capture timestamp, (n, 4) face boxes), frame is None if camera stopped or timeout
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > last_seq or not self._running, timeout):
+                return None, last_seq, 0, self._boxes
+            if self._seq <= last_seq:
+                return None, last_seq, 0, self._boxes
+
+            if out is None or out.shape != self._frame.shape:
+                out = np.empty_like(self._frame)
+            np.copyto(out, self._frame)
+            return out, self._seq, self._timestamp, self._boxes
+
+
+@dataclass
+class CameraHub:
+    """
+    Process wide owner of cameras, every device is opened once no matter how many schedules use it
+    """
+    candidate_devices: Tuple[int, ...] = (0, 1, 2)
+    inference_pool: Optional[InferencePool] = None
+    _cameras: Dict[int, SharedCamera] = field(default_factory=dict)
+    _device_cache: Dict[int, int] = field(default_factory=dict)  # requested device -> device that worked
+    _idle_detectors: List[FaceDetector] = field(default_factory=list)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def _open(self, device_id: int) -> Tuple[int, cv2.VideoCapture]:
+        cached = self._device_cache.get(device_id)
+        if cached is not None:
+            cap = cv2.VideoCapture(cached)
+            if cap.isOpened():
+                return cached, cap
+            cap.release()
+            del self._device_cache[device_id]
+
+        for dev in (device_id, ) + tuple(dev for dev in self.candidate_devices if dev != device_id):
+            cap = cv2.VideoCapture(dev)
+            if cap.isOpened():
+                if dev != device_id:
+                    bot_logger.info(f"[CameraHub] {device_id} didn't work, using device {dev}")
+                self._device_cache[device_id] = dev
+                return dev, cap
+            cap.release()
+        raise RuntimeError(f"No working camera found (tried {device_id} and {self.candidate_devices})")
+
+    def subscribe(self, device_id: int, policy: DetectionPolicy,
+                  capture_format: Optional[CaptureFormat] = None) -> SharedCamera:
+        """
+        :param policy: used only if the camera is not running yet, later subscribers share the first one's
+        :param capture_format: same as policy, applies only when the camera gets opened
+        :return: running camera, call unsubscribe when done with it
+        """
+        with self._lock:
+            camera = self._cameras.get(self._device_cache.get(device_id, device_id))
+            if camera is None or not camera.running:
+                if camera is not None:
+                    # capture died, its subscribers will see that and unsubscribe on their own
+                    camera.stop()
+                real_device, cap = self._open(device_id)
+                if capture_format is not None:
+                    capture_format.apply(cap)
+                detector = None
+                if self.inference_pool is None:
+                    detector = self._idle_detectors.pop() if self._idle_detectors else FaceDetector(max_faces=1)
+                camera = SharedCamera(device_id=real_device, cap=cap, detector=detector, policy=policy,
+                                      inference_pool=self.inference_pool)
+                camera.start()
+                self._cameras[real_device] = camera
+                bot_logger.info(f"[CameraHub] camera {real_device} opened")
+            camera.subscribers += 1
+            return camera
+
+    def unsubscribe(self, camera: SharedCamera) -> None:
+        with self._lock:
+            camera.subscribers -= 1
+            if camera.subscribers > 0:
+                return
+            if self._cameras.get(camera.device_id) is camera:
+                del self._cameras[camera.device_id]
+        camera.stop()
+        if camera.detector is not None:
+            with self._lock:
+                # model graph is expensive to build, keep it for the next camera
+                self._idle_detectors.append(camera.detector)
+        bot_logger.info(f"[CameraHub] camera {camera.device_id} released")
+
+    def prewarm(self, count: int = 1, model: str = "mesh") -> None:
+        """
+        Builds (and runs once) detectors ahead of time, they are used by the next opened cameras
+        """
+        for _ in range(count):
+            detector = FaceDetector(max_faces=1)
+            detector.warm_up(model=model)
+            with self._lock:
+                self._idle_detectors.append(detector)
+        bot_logger.info(f"[CameraHub] {count} detectors ready")
+
+    def use_inference_pool(self, workers: int) -> InferencePool:
+        """
+        Moves inference of cameras opened from now on to worker processes
+        """
+        if self.inference_pool is None:
+            self.inference_pool = InferencePool(workers=workers)
+            self.inference_pool.start()
+        return self.inference_pool
+
+    def stop_inference_pool(self) -> None:
+        # cameras opened after this use their own detector again
+        with self._lock:
+            pool, self.inference_pool = self.inference_pool, None
+        if pool is not None:
+            pool.stop()
+
+
+camera_hub = CameraHub()
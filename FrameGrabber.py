@@ -0,0 +1,115 @@
+from dataclasses import dataclass, field
+from time import time
+from typing import Optional, Tuple
+import threading
+import numpy as np
+import cv2
+
+from MocneBoty.BotLogger import bot_logger
+from MocneBoty.Stats import stats
+
+
+@dataclass
+class CaptureFormat:
+    """
+    Resolution/fps asked from the camera, 0 = leave driver default. Driver may pick the closest mode it has
+    """
+    width: int = 0
+    height: int = 0
+    fps: float = 0
+    fourcc: str = ""  # e.g. "MJPG", most webcams give HD at full fps only compressed
+
+    def apply(self, cap: cv2.VideoCapture) -> None:
+        if self.fourcc:
+            cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.fourcc))
+        if self.width:
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        if self.height:
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        if self.fps:
+            cap.set(cv2.CAP_PROP_FPS, self.fps)
+        if self.width or self.height or self.fps:
+            bot_logger.info(f"[CaptureFormat] asked for {self.width}x{self.height}@{self.fps}, got "
+                            f"{int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))}"
+                            f"@{cap.get(cv2.CAP_PROP_FPS)}")
+
+
+@dataclass
+class FrameGrabber:
+    """
+    Reads camera on its own thread so slow inference never stalls capture (and driver doesn't pile up
+    stale frames). Keeps only the newest frame, two preallocated buffers are swapped instead of allocating
+    new array every frame
+    """
+    cap: cv2.VideoCapture
+    name: str = "FrameGrabber"
+    _front: Optional[np.ndarray] = field(init=False, default=None)  # newest complete frame
+    _back: Optional[np.ndarray] = field(init=False, default=None)  # frame being captured
+    _seq: int = field(init=False, default=0)
+    _timestamp: float = field(init=False, default=0)
+    _cond: threading.Condition = field(init=False, default_factory=threading.Condition)
+    _thread: Optional[threading.Thread] = field(init=False, default=None)
+    _running: bool = field(init=False, default=False)
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._capture, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _capture(self) -> None:
+        # waiting in grab is just camera fps, retrieve (decode) is the actual cost
+        retrieve_time = stats.histogram("webcam_stage_seconds", stage="capture")
+        while self._running and self.cap.isOpened():
+            if not self.cap.grab():
+                break
+            # grab returns when frame arrived, closer to real capture time than after decoding
+            timestamp = time()
+            with retrieve_time.time():
+                success, frame = self.cap.retrieve(self._back)
+            if not success:
+                break
+
+            with self._cond:
+                if frame is not self._back:
+                    # first frame or resolution changed, from now on buffers get reused
+                    self._front = np.empty_like(frame)
+                self._back, self._front = self._front, frame
+                self._seq += 1
+                self._timestamp = timestamp
+                self._cond.notify_all()
+
+        bot_logger.info(f"[{self.name}] capture stopped")
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    def read(self, out: Optional[np.ndarray], last_seq: int = 0,
+             timeout: Optional[float] = None) -> Tuple[Optional[np.ndarray], int, float]:
+        """
+        Waits for frame newer than last_seq and copies it to out
+        :param out: consumer's buffer, reused if shape matches (new one is allocated otherwise)
+        :return: (frame, seq, capture timestamp), frame is None if capture stopped or timeout passed
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > last_seq or not self._running, timeout):
+                return None, last_seq, 0
+            if self._seq <= last_seq:
+                return None, last_seq, 0
+
+            if out is None or out.shape != self._front.shape:
+                out = np.empty_like(self._front)
+            np.copyto(out, self._front)
+            return out, self._seq, self._timestamp
@@ -0,0 +1,170 @@
+from dataclasses import dataclass, field
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+from time import monotonic
+from typing import List, Tuple
+import multiprocessing as mp_proc
+import atexit
+import queue
+import threading
+import numpy as np
+
+from MocneBoty.BotLogger import bot_logger
+
+
+def _worker_main(conn: Connection, shm_name: str, max_faces: int) -> None:
+    """
+    Runs in a separate process, frames come through shared memory, only (shape, model, inference_width) goes
+    through the pipe
+    """
+    # imported in the worker, parent process doesn't have to load mediapipe for this
+    from MocneBoty.WorkScheduleWebcam import FaceDetector
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    detector = FaceDetector(max_faces=max_faces)
+    try:
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            shape, model, inference_width = request
+            frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+            try:
+                conn.send(detector.get_boxes(frame, model=model, inference_width=inference_width))
+            except Exception as e:
+                conn.send(e)
+            del frame  # view has to be gone before shm.close()
+    finally:
+        shm.close()
+
+
+@dataclass
+class InferenceWorker:
+    process: mp_proc.Process
+    conn: Connection
+    shm: shared_memory.SharedMemory
+
+
+@dataclass
+class InferencePool:
+    """
+    Face inference in worker processes (each one with warm FaceMesh), so it doesn't fight bot threads for
+    the GIL. Every worker has its own shared memory slot, frame is copied there and never pickled
+    """
+    workers: int = 2
+    max_faces: int = 1
+    max_frame_shape: Tuple[int, int, int] = (1080, 1920, 3)
+    _workers: List[InferenceWorker] = field(init=False, default_factory=list)
+    _idle: queue.Queue = field(init=False, default_factory=queue.Queue)  # worker indices, None = pool stopped
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _closed: bool = field(init=False, default=False)  # stop() is final
+
+    def _spawn(self, ind: int, shm: shared_memory.SharedMemory) -> InferenceWorker:
+        # spawn, forking a process with running threads (and cv2/mediapipe state) is asking for trouble
+        ctx = mp_proc.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe()
+        process = ctx.Process(target=_worker_main, name=f"InferenceWorker-{ind}", daemon=True,
+                              args=(child_conn, shm.name, self.max_faces))
+        process.start()
+        child_conn.close()
+        return InferenceWorker(process=process, conn=parent_conn, shm=shm)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._workers or self._closed:
+                return
+            slot_size = int(np.prod(self.max_frame_shape))
+            for ind in range(self.workers):
+                shm = shared_memory.SharedMemory(create=True, size=slot_size)
+                self._workers.append(self._spawn(ind, shm))
+                self._idle.put(ind)
+        # shared memory outlives the process if it's not unlinked, stop() twice is fine
+        atexit.register(self.stop)
+        bot_logger.info(f"[InferencePool] {self.workers} workers started")
+
+    def stop(self, timeout: float = 5) -> None:
+        """
+        Waits (up to timeout) until running get_boxes calls give their workers back, only then workers get
+        the shutdown message, so nothing else uses their pipes at that point. Callers waiting for a worker
+        get RuntimeError
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            workers = self._workers
+        end = monotonic() + timeout
+        returned = 0
+        try:
+            while returned < len(workers):
+                self._idle.get(timeout=max(0.0, end - monotonic()))
+                returned += 1
+        except queue.Empty:
+            bot_logger.error(f"[InferencePool] {len(workers) - returned} workers still busy, terminating them")
+        # one waiting caller wakes up on it and passes it on to the next one (get_boxes)
+        self._idle.put(None)
+
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+            worker.shm.close()
+            worker.shm.unlink()
+        self._workers = []
+        if workers:
+            bot_logger.info(f"[InferencePool] stopped")
+
+    def _recycle(self, ind: int, worker: InferenceWorker) -> None:
+        """
+        Worker goes back to idle ones, dead one (crash, killed by OOM) is replaced first so it isn't handed out
+        again. Its shared memory slot is reused
+        """
+        if not worker.process.is_alive():
+            with self._lock:
+                # stopping pool doesn't respawn, stop() only waits for the index
+                if not self._closed:
+                    bot_logger.error(f"[InferencePool] worker {ind} died (exit code {worker.process.exitcode}), "
+                                     f"respawning")
+                    worker.conn.close()
+                    self._workers[ind] = self._spawn(ind, worker.shm)
+        self._idle.put(ind)
+
+    def get_boxes(self, frame: np.ndarray, model: str = "mesh", inference_width: int = 0) -> np.ndarray:
+        """
+        Same as FaceDetector.get_boxes, blocks until some worker is free
+        :return: (n_faces, 4) int32 boxes
+        """
+        if self._closed:
+            raise RuntimeError("InferencePool is stopped")
+        if not self._workers:
+            raise RuntimeError("InferencePool is not started")
+        if frame.nbytes > int(np.prod(self.max_frame_shape)):
+            raise ValueError(f"Frame {frame.shape} doesn't fit shared memory slot {self.max_frame_shape}")
+
+        ind = self._idle.get()
+        if ind is None or self._closed:
+            # stopped while waiting, worker goes to stop() and the sentinel to the next waiting caller
+            self._idle.put(ind)
+            raise RuntimeError("InferencePool is stopped")
+        worker = self._workers[ind]
+        try:
+            slot = np.ndarray(frame.shape, dtype=np.uint8, buffer=worker.shm.buf)
+            np.copyto(slot, frame)
+            del slot
+            worker.conn.send((frame.shape, model, inference_width))
+            result = worker.conn.recv()
+        except (EOFError, OSError):
+            # pipe of a dead worker, is_alive can still be True for a moment after that
+            worker.process.join(timeout=1)
+            raise
+        finally:
+            self._recycle(ind, worker)
+
+        if isinstance(result, Exception):
+            raise result
+        return result
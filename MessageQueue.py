@@ -0,0 +1,323 @@
+from collections import deque
+from dataclasses import dataclass, field
+from time import monotonic, sleep
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+import heapq
+import itertools
+import threading
+import telebot
+from telebot.apihelper import ApiTelegramException
+
+from MocneBoty.BotLogger import bot_logger
+from MocneBoty.Stats import Counter, Histogram, stats
+
+
+@dataclass
+class TokenBucket:
+    rate: float  # tokens per second
+    capacity: float
+    tokens: float = -1
+    last: float = 0
+
+    def __post_init__(self) -> None:
+        if self.tokens < 0:
+            self.tokens = self.capacity
+
+    def wait_time(self, now: float) -> float:
+        """
+        :return: 0 if token is available (it's not taken), otherwise seconds until next one
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+@dataclass
+class OutgoingMessage:
+    chat_id: int
+    text: Any  # photo for send_photo
+    kwargs: Dict[str, Any]
+    coalesce_key: Optional[str]
+    enqueued_at: float
+    attempts: int = 0
+    method: str = "send_message"  # TeleBot method used to deliver it
+
+
+@dataclass
+class ChatQueue:
+    bucket: TokenBucket
+    messages: Deque[OutgoingMessage] = field(default_factory=deque)
+    blocked_until: float = 0
+    heap_seq: int = -1  # seq of chat's current entry in SenderShard.ready, older entries are stale
+
+    def refilled_at(self) -> float:
+        bucket = self.bucket
+        return max(self.blocked_until, bucket.last + (bucket.capacity - bucket.tokens) / bucket.rate)
+
+
+@dataclass
+class SenderShard:
+    """
+    Chats handled by one sender worker, chats are served in order they become able to send and each chat
+    keeps its own order. Worker looks only at the top of ready heap, never at all chats
+    """
+    chats: Dict[int, ChatQueue] = field(default_factory=dict)
+    ready: List[Tuple[float, int, int]] = field(default_factory=list)  # (time chat can send, seq, chat id)
+    seq: Iterator[int] = field(default_factory=itertools.count)
+    cond: threading.Condition = field(default_factory=threading.Condition)
+
+    def schedule(self, chat_id: int, chat_queue: ChatQueue, at: float) -> None:
+        # must be called with cond held
+        chat_queue.heap_seq = next(self.seq)
+        heapq.heappush(self.ready, (at, chat_queue.heap_seq, chat_id))
+
+
+@dataclass
+class MessageQueue:
+    """
+    Outbound queue for notifications, schedules call send_message which only enqueues, sender workers
+    deliver with per chat + global rate limits, retries (429 retry_after is honored) and coalescing of
+    status messages with the same coalesce_key that are still waiting in the queue
+    """
+    bot: telebot.TeleBot
+    workers: int = 2
+    global_rate: float = 30.0  # telegram allows ~30 msg/s per bot
+    global_burst: float = 30.0
+    chat_rate: float = 1.0  # and ~1 msg/s per chat
+    chat_burst: float = 3.0
+    max_retries: int = 5
+    backoff: float = 1.0
+    max_backoff: float = 60.0
+    clock: Callable[[], float] = monotonic
+    _shards: List[SenderShard] = field(init=False, default_factory=list)
+    _pending_keys: Dict[str, OutgoingMessage] = field(init=False, default_factory=dict)
+    _global_bucket: TokenBucket = field(init=False)
+    _global_lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _counters_lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _threads: List[threading.Thread] = field(init=False, default_factory=list)
+    _running: bool = field(init=False, default=False)
+    _stopped: bool = field(init=False, default=False)  # stop() is final, later messages are dropped
+    _state_lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _send_latency: Histogram = field(init=False)
+    _api_time: Dict[str, Histogram] = field(init=False)  # by TeleBot method
+    _results: Dict[str, Counter] = field(init=False)
+    _counters: Dict[str, float] = field(init=False, default_factory=lambda: {
+        "enqueued": 0, "sent": 0, "failed": 0, "retried": 0, "coalesced": 0, "latency_sum": 0, "latency_max": 0
+    })
+
+    def __post_init__(self) -> None:
+        self._shards = [SenderShard() for _ in range(self.workers)]
+        # looked up once, registry lock isn't taken for every message
+        self._send_latency = stats.histogram("send_latency_seconds")
+        self._api_time = {method: stats.histogram("api_call_seconds", method=method)
+                          for method in ("send_message", "send_photo")}
+        self._results = {result: stats.counter("messages_total", result=result)
+                         for result in ("enqueued", "sent", "failed", "retried", "coalesced")}
+        self._global_bucket = TokenBucket(rate=self.global_rate, capacity=self.global_burst, last=self.clock())
+
+    def start(self) -> None:
+        """
+        Starts sender workers (TelegramBot.start does it), messages sent before that wait in the queue
+        """
+        # locked, two workers on one shard would break per chat order
+        with self._state_lock:
+            if self._running or self._stopped:
+                return
+            self._running = True
+            for ind, shard in enumerate(self._shards):
+                thread = threading.Thread(target=self._worker, args=(shard,), name=f"MessageSender-{ind}",
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        with self._state_lock:
+            self._running = False
+            self._stopped = True
+        for shard in self._shards:
+            with shard.cond:
+                shard.cond.notify()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until queue is empty (sent or dropped), used before stop on graceful shutdown
+        """
+        end = None if timeout is None else monotonic() + timeout
+        while self.depth():
+            if end is not None and monotonic() >= end:
+                return False
+            sleep(0.05)
+        return True
+
+    def _count(self, name: str, value: float = 1) -> None:
+        with self._counters_lock:
+            self._counters[name] += value
+        self._results[name].inc(value)
+
+    def _shard(self, chat_id: int) -> SenderShard:
+        return self._shards[hash(chat_id) % len(self._shards)]
+
+    def send_message(self, chat_id: int, text: str, coalesce_key: Optional[str] = None, **kwargs) -> None:
+        """
+        Same call as TeleBot.send_message but returns right away
+        :param coalesce_key: if message with the same key is still queued its content is replaced by this one
+        """
+        self._enqueue(chat_id, text, "send_message", coalesce_key, kwargs)
+
+    def send_photo(self, chat_id: int, photo: Any, coalesce_key: Optional[str] = None, **kwargs) -> None:
+        """
+        Same as send_message, for TeleBot.send_photo (photo = bytes, file or file id)
+        """
+        self._enqueue(chat_id, photo, "send_photo", coalesce_key, kwargs)
+
+    def _enqueue(self, chat_id: int, text: Any, method: str, coalesce_key: Optional[str],
+                 kwargs: Dict[str, Any]) -> None:
+        if self._stopped:
+            self._count("failed")
+            bot_logger.warning(f"[MessageQueue - {chat_id}] {method} after stop, message dropped")
+            return
+        shard = self._shard(chat_id)
+        self._count("enqueued")
+        with shard.cond:
+            if coalesce_key is not None:
+                pending = self._pending_keys.get(coalesce_key)
+                if pending is not None and pending.chat_id == chat_id and pending.method == method:
+                    pending.text, pending.kwargs = text, kwargs
+                    self._count("coalesced")
+                    return
+
+            msg = OutgoingMessage(chat_id=chat_id, text=text, kwargs=kwargs, coalesce_key=coalesce_key,
+                                  enqueued_at=self.clock(), method=method)
+            if coalesce_key is not None:
+                self._pending_keys[coalesce_key] = msg
+
+            chat_queue = shard.chats.get(chat_id)
+            if chat_queue is None:
+                chat_queue = ChatQueue(bucket=TokenBucket(rate=self.chat_rate, capacity=self.chat_burst,
+                                                          last=self.clock()))
+                shard.chats[chat_id] = chat_queue
+            if not chat_queue.messages:
+                # chat with messages is in the heap already, idle one is there only to be forgotten later
+                shard.schedule(chat_id, chat_queue, self.clock())
+            chat_queue.messages.append(msg)
+            shard.cond.notify()
+
+    def depth(self) -> int:
+        total = 0
+        for shard in self._shards:
+            with shard.cond:
+                total += sum(len(chat_queue.messages) for chat_queue in shard.chats.values())
+        return total
+
+    def stats(self) -> Dict[str, float]:
+        with self._counters_lock:
+            stats = dict(self._counters)
+        stats["depth"] = self.depth()
+        stats["latency_avg"] = stats["latency_sum"] / stats["sent"] if stats["sent"] else 0
+        return stats
+
+    def _next_message(self, shard: SenderShard) -> Optional[OutgoingMessage]:
+        """
+        Must be called with shard.cond held, waits until some chat is allowed to send
+        :return: message or None when queue is stopping
+        """
+        while self._running:
+            now = self.clock()
+            wait = None
+            while shard.ready:
+                at, seq, chat_id = shard.ready[0]
+                if at > now:
+                    wait = at - now
+                    break
+                chat_queue = shard.chats.get(chat_id)
+                if chat_queue is None or chat_queue.heap_seq != seq:
+                    heapq.heappop(shard.ready)
+                    continue
+                if not chat_queue.messages:
+                    # idle chat is forgotten only once its bucket refilled, so it can't reset rate limit by that
+                    heapq.heappop(shard.ready)
+                    chat_queue.bucket.wait_time(now)
+                    if chat_queue.refilled_at() <= now:
+                        del shard.chats[chat_id]
+                    else:
+                        shard.schedule(chat_id, chat_queue, chat_queue.refilled_at())
+                    continue
+                chat_wait = max(chat_queue.blocked_until - now, chat_queue.bucket.wait_time(now))
+                if chat_wait > 0:
+                    heapq.heappop(shard.ready)
+                    shard.schedule(chat_id, chat_queue, now + chat_wait)
+                    continue
+
+                with self._global_lock:
+                    global_wait = self._global_bucket.wait_time(now)
+                    if global_wait <= 0:
+                        self._global_bucket.take()
+                if global_wait > 0:
+                    # chat stays first in line, nobody else in this shard could send either
+                    wait = global_wait
+                    break
+                heapq.heappop(shard.ready)
+                chat_queue.bucket.take()
+                msg = chat_queue.messages.popleft()
+                # behind chats that were ready before, so other chats of this shard get their turn
+                shard.schedule(chat_id, chat_queue, now if chat_queue.messages else chat_queue.refilled_at())
+                if msg.coalesce_key is not None and self._pending_keys.get(msg.coalesce_key) is msg:
+                    del self._pending_keys[msg.coalesce_key]
+                return msg
+            shard.cond.wait(wait)
+        return None
+
+    def _requeue(self, shard: SenderShard, msg: OutgoingMessage, delay: float) -> None:
+        with shard.cond:
+            chat_queue = shard.chats.get(msg.chat_id)
+            if chat_queue is None:
+                chat_queue = ChatQueue(bucket=TokenBucket(rate=self.chat_rate, capacity=self.chat_burst,
+                                                          last=self.clock()))
+                shard.chats[msg.chat_id] = chat_queue
+            chat_queue.messages.appendleft(msg)
+            chat_queue.blocked_until = self.clock() + delay
+            shard.schedule(msg.chat_id, chat_queue, chat_queue.blocked_until)
+
+    def _worker(self, shard: SenderShard) -> None:
+        while True:
+            with shard.cond:
+                msg = self._next_message(shard)
+            if msg is None:
+                return
+
+            try:
+                with self._api_time[msg.method].time():
+                    getattr(self.bot, msg.method)(msg.chat_id, msg.text, **msg.kwargs)
+            except Exception as e:
+                msg.attempts += 1
+                # 400/403 (chat not found, bot blocked...) won't get better with retrying
+                permanent = isinstance(e, ApiTelegramException) and e.error_code in (400, 403)
+                if permanent or msg.attempts > self.max_retries:
+                    self._count("failed")
+                    bot_logger.error(f"[MessageQueue - {msg.chat_id}] dropping message after {msg.attempts} "
+                                     f"attempts: {e}")
+                    continue
+
+                delay = min(self.backoff * 2 ** (msg.attempts - 1), self.max_backoff)
+                if isinstance(e, ApiTelegramException) and e.error_code == 429:
+                    delay = (e.result_json or {}).get("parameters", {}).get("retry_after", delay)
+                self._count("retried")
+                bot_logger.info(f"[MessageQueue - {msg.chat_id}] send failed ({e}), retry in {delay}s")
+                self._requeue(shard, msg, delay)
+                continue
+
+            latency = self.clock() - msg.enqueued_at
+            with self._counters_lock:
+                self._counters["sent"] += 1
+                self._counters["latency_sum"] += latency
+                self._counters["latency_max"] = max(self._counters["latency_max"], latency)
+            self._send_latency.observe(latency)
+            self._results["sent"].inc()
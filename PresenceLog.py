@@ -0,0 +1,376 @@
+from array import array
+from dataclasses import dataclass, field, fields
+from datetime import date, datetime, timedelta
+from time import monotonic
+from typing import Dict, Iterator, List, Optional, Tuple
+import queue
+import sqlite3
+import threading
+
+from MocneBoty.BotLogger import bot_logger
+
+
+# run kinds, phase * 2 + present
+WORK_ABSENT, WORK_PRESENT, BREAK_ABSENT, BREAK_PRESENT = range(4)
+
+
+@dataclass
+class DaySummary:
+    """
+    One row of presence_days, seconds except the counts
+    """
+    work_present: float = 0
+    work_absent: float = 0
+    break_present: float = 0
+    break_absent: float = 0
+    breaks_taken: int = 0
+    breaks_skipped: int = 0
+    streaks: int = 0  # focus streaks at least PresenceRecorder.focus_min long
+    longest_streak: float = 0
+
+    def merge(self, other: "DaySummary") -> None:
+        for f in fields(self):
+            if f.name == "longest_streak":
+                self.longest_streak = max(self.longest_streak, other.longest_streak)
+            else:
+                setattr(self, f.name, getattr(self, f.name) + getattr(other, f.name))
+
+
+SUMMARY_COLUMNS = tuple(f.name for f in fields(DaySummary))
+
+
+def day_key(timestamp: float) -> str:
+    return date.fromtimestamp(timestamp).isoformat()
+
+
+def _split_days(start: float, end: float) -> Iterator[Tuple[str, float]]:
+    """
+    (day, seconds) parts of start..end, run going over midnight counts for both days
+    """
+    while True:
+        day = date.fromtimestamp(start)
+        midnight = datetime.combine(day + timedelta(days=1), datetime.min.time()).timestamp()
+        if end <= midnight:
+            yield day.isoformat(), end - start
+            return
+        yield day.isoformat(), midnight - start
+        start = midnight
+
+
+@dataclass
+class PresenceStore:
+    """
+    SQLite (WAL) presence history, raw runs (presence_runs) and per day totals (presence_days) that reports
+    read, so a month long report sums 30 rows instead of going through every run. Writes are batched by
+    writer thread the same way as in ScheduleStore
+    """
+    db_path: str = "presence.db"
+    flush_interval: float = 1.0  # seconds
+    max_batch: int = 1000
+    _queue: queue.SimpleQueue = field(init=False, default_factory=queue.SimpleQueue)
+    _thread: Optional[threading.Thread] = field(init=False, default=None)
+    _flushed: threading.Condition = field(init=False, default_factory=threading.Condition)
+    _pending: int = field(init=False, default=0)
+    _thread_lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _stopped: bool = field(init=False, default=False)  # stop() is final, later writes are dropped
+
+    def __post_init__(self) -> None:
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS presence_runs (
+                chat_id INTEGER NOT NULL,
+                schedule_id INTEGER NOT NULL,
+                start REAL NOT NULL,
+                end REAL NOT NULL,
+                kind INTEGER NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS presence_runs_chat ON presence_runs (chat_id, start)")
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS presence_days (
+                chat_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                {', '.join(f'{col} REAL NOT NULL DEFAULT 0' for col in SUMMARY_COLUMNS)},
+                PRIMARY KEY (chat_id, day)
+            )
+        """)
+        conn.commit()
+        conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _start_writer(self) -> None:
+        # must be called with _thread_lock held, one writer per queue (same as ScheduleStore)
+        if self._thread is None and not self._stopped:
+            self._thread = threading.Thread(target=self._writer, name="PresenceStore", daemon=True)
+            self._thread.start()
+
+    def start(self) -> None:
+        with self._thread_lock:
+            self._start_writer()
+
+    def stop(self) -> None:
+        with self._thread_lock:
+            self._stopped = True
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def add(self, chat_id: int, schedule_id: int, runs: List[Tuple[float, float, int]],
+            days: Dict[str, DaySummary]) -> None:
+        """
+        :param runs: finished (start, end, kind) runs
+        :param days: what they add to the day totals
+        """
+        # webcam thread still finishing after shutdown mustn't bring the writer back
+        with self._thread_lock:
+            if self._stopped:
+                bot_logger.warning(f"[PresenceStore - {chat_id}] {len(runs)} runs of schedule {schedule_id} "
+                                   f"after stop, not written")
+                return
+            self._start_writer()
+            with self._flushed:
+                self._pending += 1
+            self._queue.put((chat_id, schedule_id, runs, days))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until everything added so far is committed
+        """
+        with self._flushed:
+            return self._flushed.wait_for(lambda: self._pending == 0, timeout)
+
+    def days(self, chat_id: int, first_day: str, last_day: str) -> List[Tuple[str, DaySummary]]:
+        """
+        :param first_day: iso date, inclusive (same for last_day)
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(f"SELECT day, {', '.join(SUMMARY_COLUMNS)} FROM presence_days "
+                                f"WHERE chat_id = ? AND day BETWEEN ? AND ? ORDER BY day",
+                                (chat_id, first_day, last_day)).fetchall()
+        finally:
+            conn.close()
+        return [(row[0], DaySummary(*row[1:])) for row in rows]
+
+    def report(self, chat_id: int, period: str = "day") -> str:
+        """
+        /report text, read from per day totals so it doesn't depend on how much history there is
+        :param period: "day" (today) or "week" (last 7 days, today included)
+        """
+        last = date.today()
+        first = last - timedelta(days=6) if period == "week" else last
+        days = self.days(chat_id, first.isoformat(), last.isoformat())
+        title = f"Report {last}" if first == last else f"Report {first} - {last}"
+        return format_report(title, days, per_day=period == "week")
+
+    def _writer(self) -> None:
+        conn = self._connect()
+        upsert_sql = f"INSERT INTO presence_days (chat_id, day, {', '.join(SUMMARY_COLUMNS)}) " \
+                     f"VALUES (?, ?, {', '.join('?' for _ in SUMMARY_COLUMNS)}) " \
+                     f"ON CONFLICT (chat_id, day) DO UPDATE SET " + \
+                     ", ".join(f"{col} = MAX({col}, excluded.{col})" if col == "longest_streak" else
+                               f"{col} = {col} + excluded.{col}" for col in SUMMARY_COLUMNS)
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            flush_at = monotonic() + self.flush_interval
+            try:
+                while len(batch) < self.max_batch and batch[-1] is not None:
+                    batch.append(self._queue.get(timeout=max(0.0, flush_at - monotonic())))
+            except queue.Empty:
+                pass
+
+            runs = []
+            days: Dict[Tuple[int, str], DaySummary] = {}
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                chat_id, schedule_id, item_runs, item_days = item
+                runs.extend((chat_id, schedule_id, start, end, kind) for start, end, kind in item_runs)
+                for day, summary in item_days.items():
+                    days.setdefault((chat_id, day), DaySummary()).merge(summary)
+
+            try:
+                with conn:
+                    conn.executemany("INSERT INTO presence_runs (chat_id, schedule_id, start, end, kind) "
+                                     "VALUES (?, ?, ?, ?, ?)", runs)
+                    conn.executemany(upsert_sql, [(chat_id, day, *(getattr(summary, col) for col in SUMMARY_COLUMNS))
+                                                  for (chat_id, day), summary in days.items()])
+            except sqlite3.Error as e:
+                bot_logger.error(f"[PresenceStore] failed to write {len(runs)} runs: {e}")
+
+            with self._flushed:
+                self._pending -= sum(1 for item in batch if item is not None)
+                self._flushed.notify_all()
+        conn.close()
+
+
+@dataclass
+class PresenceRecorder:
+    """
+    Presence of one webcam session as run length intervals (start, end, kind) in flat arrays. Frame with the
+    same kind as the previous one only moves end of the last run, so per frame cost is O(1) and memory grows
+    with state changes, not with frames. Finished runs are folded into day totals and handed to store
+    every flush_interval seconds (of frame time)
+    """
+    store: Optional[PresenceStore]
+    chat_id: int
+    schedule_id: int
+    max_gap: float = 5.0  # no frame for longer than that = hole in the log (camera stalled, schedule paused)
+    flush_interval: float = 60.0
+    focus_min: float = 600.0  # shorter presence at work isn't counted as focus streak
+    streak_gap: float = 30.0  # absence up to that long doesn't break a streak
+    skip_ratio: float = 0.5  # break with user present for more than that part of it counts as skipped
+    _starts: array = field(init=False, default_factory=lambda: array("d"))
+    _ends: array = field(init=False, default_factory=lambda: array("d"))
+    _kinds: array = field(init=False, default_factory=lambda: array("B"))
+    _days: Dict[str, DaySummary] = field(init=False, default_factory=dict)  # not flushed yet
+    _last_flush: Optional[float] = field(init=False, default=None)
+    _phase_working: Optional[bool] = field(init=False, default=None)
+    _phase_start: float = field(init=False, default=0)
+    _phase_present: float = field(init=False, default=0)
+    _streak: Optional[List[float]] = field(init=False, default=None)  # [start, end]
+
+    def __len__(self) -> int:
+        return len(self._kinds)
+
+    def record(self, frame_time: float, present: bool, working: bool) -> None:
+        """
+        Called for every analysed frame
+        """
+        kind = (0 if working else 2) + present
+        if self._kinds:
+            last_end = self._ends[-1]
+            if frame_time - last_end <= self.max_gap:
+                # previous run lasts until this frame, so consecutive runs have no holes between them
+                self._ends[-1] = frame_time
+                if self._kinds[-1] == kind:
+                    if frame_time - self._last_flush >= self.flush_interval:
+                        self.flush(frame_time)
+                    return
+        self._starts.append(frame_time)
+        self._ends.append(frame_time)
+        self._kinds.append(kind)
+        if self._last_flush is None:
+            self._last_flush = frame_time
+        elif frame_time - self._last_flush >= self.flush_interval:
+            self.flush(frame_time)
+
+    def flush(self, now: Optional[float] = None, final: bool = False) -> None:
+        """
+        Folds finished runs into day totals and hands them to store. Long unchanged run is cut at the last frame,
+        so running session shows up in reports every flush_interval too
+        :param final: session is over, last run is finished as well and so is the current phase/streak
+        """
+        if not self._kinds:
+            return
+        if not final:
+            # cut open run: [start, end] goes out, the rest continues from end with the same kind
+            cut = self._ends[-1]
+            if cut > self._starts[-1]:
+                kind = self._kinds[-1]
+                self._starts.append(cut)
+                self._ends.append(cut)
+                self._kinds.append(kind)
+        finished = len(self._kinds) if final else len(self._kinds) - 1
+        for ind in range(finished):
+            self._fold(self._starts[ind], self._ends[ind], self._kinds[ind])
+        if final:
+            self._end_phase(self._ends[-1])
+
+        runs = [(self._starts[ind], self._ends[ind], self._kinds[ind]) for ind in range(finished)
+                if self._ends[ind] > self._starts[ind]]
+        del self._starts[:finished], self._ends[:finished], self._kinds[:finished]
+        self._last_flush = now if now is not None else self._last_flush
+        days, self._days = self._days, {}
+        if self.store is not None and (runs or days):
+            self.store.add(self.chat_id, self.schedule_id, runs, days)
+
+    def close(self) -> None:
+        self.flush(final=True)
+
+    def _day(self, day: str) -> DaySummary:
+        summary = self._days.get(day)
+        if summary is None:
+            summary = self._days[day] = DaySummary()
+        return summary
+
+    def _fold(self, start: float, end: float, kind: int) -> None:
+        working, present = kind < BREAK_ABSENT, bool(kind & 1)
+        if self._phase_working is not working:
+            self._end_phase(start)
+            self._phase_working, self._phase_start, self._phase_present = working, start, 0
+
+        column = ("work_" if working else "break_") + ("present" if present else "absent")
+        for day, seconds in _split_days(start, end):
+            summary = self._day(day)
+            setattr(summary, column, getattr(summary, column) + seconds)
+
+        if present:
+            self._phase_present += end - start
+        if working and present:
+            if self._streak is not None and start - self._streak[1] > self.streak_gap:
+                self._end_streak()
+            if self._streak is None:
+                self._streak = [start, end]
+            self._streak[1] = end
+
+    def _end_phase(self, end: float) -> None:
+        if self._phase_working is None:
+            return
+        if self._phase_working:
+            self._end_streak()
+        elif end > self._phase_start:
+            summary = self._day(day_key(end))
+            if self._phase_present / (end - self._phase_start) > self.skip_ratio:
+                summary.breaks_skipped += 1
+            else:
+                summary.breaks_taken += 1
+        self._phase_working = None
+
+    def _end_streak(self) -> None:
+        if self._streak is None:
+            return
+        start, end = self._streak
+        self._streak = None
+        summary = self._day(day_key(end))
+        summary.longest_streak = max(summary.longest_streak, end - start)
+        if end - start >= self.focus_min:
+            summary.streaks += 1
+
+
+def _duration(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    return f"{minutes // 60}h {minutes % 60}m" if minutes >= 60 else f"{minutes}m"
+
+
+def format_report(title: str, days: List[Tuple[str, DaySummary]], per_day: bool = False,
+                  focus_min: float = 600.0) -> str:
+    """
+    /report text, totals of all given days (+ one line per day if per_day)
+    """
+    if not days:
+        return f"{title}\nNo webcam sessions recorded"
+    total = DaySummary()
+    for _, summary in days:
+        total.merge(summary)
+
+    report = f"{title}\n" \
+             f"Present during work: {_duration(total.work_present)} (away {_duration(total.work_absent)})\n" \
+             f"Breaks: {total.breaks_taken:g} taken, {total.breaks_skipped:g} skipped " \
+             f"(present {_duration(total.break_present)} of {_duration(total.break_present + total.break_absent)})\n" \
+             f"Focus streaks ({_duration(focus_min)}+): {total.streaks:g}, " \
+             f"longest {_duration(total.longest_streak)}"
+    if per_day:
+        for day, summary in days:
+            report += f"\n  {day}: {_duration(summary.work_present)} at work, breaks " \
+                      f"{summary.breaks_taken:g}/{summary.breaks_taken + summary.breaks_skipped:g}, " \
+                      f"longest streak {_duration(summary.longest_streak)}"
+    return report
@@ -0,0 +1,152 @@
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+import queue
+import sqlite3
+import threading
+
+from MocneBoty.BotLogger import bot_logger
+
+
+SCHEDULE_COLUMNS = ("thread_id", "chat_id", "task_name", "work_time", "break_time", "repeat", "phase",
+                    "repeat_count", "deadline")
+
+
+@dataclass
+class ScheduleStore:
+    """
+    SQLite (WAL) copy of running schedules so they survive restart. save/delete only put the row on a queue,
+    writer thread commits whatever piled up in one transaction, so schedules never wait for the disk
+    """
+    db_path: str = "schedules.db"
+    flush_interval: float = 0.2  # seconds
+    max_batch: int = 5000
+    _queue: queue.SimpleQueue = field(init=False, default_factory=queue.SimpleQueue)
+    _thread: Optional[threading.Thread] = field(init=False, default=None)
+    _flushed: threading.Condition = field(init=False, default_factory=threading.Condition)
+    _pending: int = field(init=False, default=0)
+    _thread_lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    _stopped: bool = field(init=False, default=False)  # stop() is final, later writes are dropped
+
+    def __post_init__(self) -> None:
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schedules (
+                thread_id INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL,
+                task_name TEXT NOT NULL,
+                work_time INTEGER NOT NULL,
+                break_time INTEGER NOT NULL,
+                repeat INTEGER NOT NULL,
+                phase TEXT NOT NULL,
+                repeat_count INTEGER NOT NULL,
+                deadline REAL
+            )
+        """)
+        conn.commit()
+        conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL is still crash safe for the db itself, at worst last batch is lost
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _start_writer(self) -> None:
+        # must be called with _thread_lock held. One writer per queue, two would commit their batches in any
+        # order (delete before older save)
+        if self._thread is None and not self._stopped:
+            self._thread = threading.Thread(target=self._writer, name="ScheduleStore", daemon=True)
+            self._thread.start()
+
+    def start(self) -> None:
+        with self._thread_lock:
+            self._start_writer()
+
+    def stop(self) -> None:
+        with self._thread_lock:
+            self._stopped = True
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _put(self, item: Any) -> None:
+        # queued under the lock, so everything accepted is before stop's sentinel
+        with self._thread_lock:
+            if self._stopped:
+                bot_logger.warning(f"[ScheduleStore] {item[0]} after stop, not written")
+                return
+            self._start_writer()
+            with self._flushed:
+                self._pending += 1
+            self._queue.put(item)
+
+    def save(self, row: Dict[str, Any]) -> None:
+        """
+        :param row: dict with SCHEDULE_COLUMNS keys, latest save of the same thread_id wins
+        """
+        self._put(("save", row))
+
+    def delete(self, thread_id: int) -> None:
+        self._put(("delete", thread_id))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until everything queued so far is committed
+        """
+        with self._flushed:
+            return self._flushed.wait_for(lambda: self._pending == 0, timeout)
+
+    def load_rows(self) -> List[Tuple]:
+        """
+        Raw tuples in SCHEDULE_COLUMNS order, restore of a lot of schedules doesn't pay for a dict per row
+        """
+        conn = self._connect()
+        try:
+            return conn.execute(f"SELECT {', '.join(SCHEDULE_COLUMNS)} FROM schedules").fetchall()
+        finally:
+            conn.close()
+
+    def load_all(self) -> List[Dict[str, Any]]:
+        return [dict(zip(SCHEDULE_COLUMNS, row)) for row in self.load_rows()]
+
+    def _writer(self) -> None:
+        conn = self._connect()
+        insert_sql = f"INSERT OR REPLACE INTO schedules ({', '.join(SCHEDULE_COLUMNS)}) " \
+                     f"VALUES ({', '.join(':' + col for col in SCHEDULE_COLUMNS)})"
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            flush_at = monotonic() + self.flush_interval
+            try:
+                while len(batch) < self.max_batch and batch[-1] is not None:
+                    batch.append(self._queue.get(timeout=max(0.0, flush_at - monotonic())))
+            except queue.Empty:
+                pass
+
+            # only the last operation per schedule matters
+            ops: Dict[int, Any] = {}
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                action, value = item
+                if action == "save":
+                    ops[value["thread_id"]] = value
+                else:
+                    ops[value] = None
+
+            try:
+                with conn:
+                    conn.executemany(insert_sql, [row for row in ops.values() if row is not None])
+                    conn.executemany("DELETE FROM schedules WHERE thread_id = ?",
+                                     [(thread_id, ) for thread_id, row in ops.items() if row is None])
+            except sqlite3.Error as e:
+                bot_logger.error(f"[ScheduleStore] failed to write {len(ops)} schedules: {e}")
+
+            with self._flushed:
+                self._pending -= sum(1 for item in batch if item is not None)
+                self._flushed.notify_all()
+        conn.close()
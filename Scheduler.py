@@ -0,0 +1,157 @@
+import heapq
+import itertools
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Tuple
+
+from MocneBoty.BotLogger import bot_logger
+from MocneBoty.Stats import Histogram, stats
+
+
+@dataclass(order=True)
+class Timer:
+    deadline: float
+    timer_id: int
+    callback: Callable = field(compare=False)
+    on_cancel: Optional[Callable] = field(compare=False, default=None)
+    cancelled: bool = field(compare=False, default=False)
+
+
+@dataclass
+class TimerScheduler:
+    """
+    One thread + min-heap of deadlines for every schedule, sleeps until the closest deadline
+    (or until something gets added/cancelled) instead of busy waiting per schedule.
+    """
+    clock: Callable[[], float] = monotonic
+    name: str = "TimerScheduler"
+    _heap: List[Timer] = field(init=False, default_factory=list)
+    _timers: Dict[int, Timer] = field(init=False, default_factory=dict)
+    _cancelled: deque = field(init=False, default_factory=deque)
+    _ids: itertools.count = field(init=False, default_factory=itertools.count)
+    _cond: threading.Condition = field(init=False, default_factory=threading.Condition)
+    _thread: Optional[threading.Thread] = field(init=False, default=None)
+    _running: bool = field(init=False, default=False)
+    _lateness: Histogram = field(init=False)
+
+    def __post_init__(self) -> None:
+        self._lateness = stats.histogram("timer_lateness_seconds", scheduler=self.name)
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def start(self) -> None:
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def call_at(self, deadline: float, callback: Callable, on_cancel: Optional[Callable] = None) -> int:
+        with self._cond:
+            timer = Timer(deadline=deadline, timer_id=next(self._ids), callback=callback, on_cancel=on_cancel)
+            self._timers[timer.timer_id] = timer
+            heapq.heappush(self._heap, timer)
+            # wake up only if new timer is the closest one, otherwise current sleep is still fine
+            if self._heap[0] is timer:
+                self._cond.notify()
+        return timer.timer_id
+
+    def call_many(self, timers: List[Tuple[float, Callable, Optional[Callable]]]) -> List[int]:
+        """
+        call_at for a lot of timers at once (restore), one heapify instead of a push per timer
+        :param timers: (deadline, callback, on_cancel)
+        :return: timer ids in the same order
+        """
+        with self._cond:
+            new = [Timer(deadline=deadline, timer_id=next(self._ids), callback=callback, on_cancel=on_cancel)
+                   for deadline, callback, on_cancel in timers]
+            self._timers.update((timer.timer_id, timer) for timer in new)
+            self._heap.extend(new)
+            heapq.heapify(self._heap)
+            self._cond.notify()
+        return [timer.timer_id for timer in new]
+
+    def call_later(self, delay: float, callback: Callable, on_cancel: Optional[Callable] = None) -> int:
+        return self.call_at(self.clock() + delay, callback, on_cancel=on_cancel)
+
+    def cancel(self, timer_id: int) -> bool:
+        """
+        Marks timer as cancelled and wakes scheduler thread, on_cancel callback (if any) is called from
+        scheduler thread right away
+        """
+        with self._cond:
+            timer = self._timers.get(timer_id)
+            if timer is None or timer.cancelled:
+                return False
+            timer.cancelled = True
+            # heap entry is dropped lazily when it reaches the top, on_cancel goes through separate queue
+            del self._timers[timer_id]
+            self._cancelled.append(timer)
+            if len(self._heap) > 2 * len(self._timers) + 64:
+                # too many dead entries, rebuild so memory doesn't grow with every /stopThread
+                self._heap = [t for t in self._heap if not t.cancelled]
+                heapq.heapify(self._heap)
+            self._cond.notify()
+        return True
+
+    def _pop_due(self) -> Optional[Timer]:
+        # must be called with self._cond held
+        if self._cancelled:
+            return self._cancelled.popleft()
+        while self._heap and self._heap[0].cancelled:
+            heapq.heappop(self._heap)
+        if self._heap and self._heap[0].deadline <= self.clock():
+            timer = heapq.heappop(self._heap)
+            del self._timers[timer.timer_id]
+            return timer
+        return None
+
+    def _fire(self, timer: Timer) -> None:
+        func = timer.on_cancel if timer.cancelled else timer.callback
+        if func is None:
+            return
+        if not timer.cancelled:
+            self._lateness.observe(max(0.0, self.clock() - timer.deadline))
+        try:
+            func()
+        except Exception as e:
+            bot_logger.error(f"[TimerScheduler] timer {timer.timer_id} callback failed: {e}")
+
+    def run_pending(self) -> int:
+        """
+        Runs every timer that is due according to self.clock, handy when clock is driven manually
+        :return: number of fired timers
+        """
+        fired = 0
+        while True:
+            with self._cond:
+                timer = self._pop_due()
+            if timer is None:
+                return fired
+            self._fire(timer)
+            fired += 1
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while self._running:
+                    timer = self._pop_due()
+                    if timer is not None:
+                        break
+                    timeout = self._heap[0].deadline - self.clock() if self._heap else None
+                    self._cond.wait(timeout)
+                else:
+                    return
+            # callbacks run outside of the lock, so they can schedule/cancel other timers
+            self._fire(timer)
@@ -0,0 +1,230 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import functools
+import inspect
+import threading
+
+from MocneBoty.BotLogger import bot_logger
+
+
+# seconds, 100us..60s covers everything from single frame stage to badly late timer
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels_key(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+@dataclass
+class Histogram:
+    """
+    Fixed buckets, observe is one bisect + three additions, nothing is allocated
+    """
+    bounds: Tuple[float, ...] = DEFAULT_BUCKETS
+    counts: List[int] = field(init=False)  # last one is +Inf
+    total: float = field(init=False, default=0)
+    count: int = field(init=False, default=0)
+    _lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+
+    def __post_init__(self) -> None:
+        self.counts = [0] * (len(self.bounds) + 1)
+
+    def observe(self, value: float) -> None:
+        ind = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[ind] += 1
+            self.total += value
+            self.count += 1
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start)
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self.counts), self.total, self.count
+
+    def quantile(self, q: float) -> float:
+        """
+        :return: upper bound of the bucket with q-th observation (inf if it's above the last bucket)
+        """
+        counts, _, count = self.snapshot()
+        rank, seen = q * count, 0
+        for ind, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return self.bounds[ind] if ind < len(self.bounds) else float("inf")
+        return 0.0
+
+
+@dataclass
+class Counter:
+    value: float = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def inc(self, value: float = 1) -> None:
+        with self._lock:
+            self.value += value
+
+
+@dataclass
+class StatsRegistry:
+    """
+    Process wide histograms/counters, get them once (histogram(), counter()) on hot paths and keep reference
+    """
+    _histograms: Dict[Tuple[str, Labels], Histogram] = field(default_factory=dict)
+    _counters: Dict[Tuple[str, Labels], Counter] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def histogram(self, name: str, bounds: Tuple[float, ...] = DEFAULT_BUCKETS, **labels) -> Histogram:
+        key = (name, _labels_key(labels))
+        hist = self._histograms.get(key)
+        if hist is None:
+            with self._lock:
+                hist = self._histograms.setdefault(key, Histogram(bounds=bounds))
+        return hist
+
+    def counter(self, name: str, **labels) -> Counter:
+        key = (name, _labels_key(labels))
+        counter = self._counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(key, Counter())
+        return counter
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        self.histogram(name, **labels).observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        self.counter(name, **labels).inc(value)
+
+    def timed(self, name: str, **labels) -> Callable:
+        """
+        Decorator, call time of the function (sync or async) goes to histogram name
+        """
+        hist = self.histogram(name, **labels)
+
+        def decorator(func: Callable) -> Callable:
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with hist.time():
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with hist.time():
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _items(self) -> Tuple[List[Tuple[Tuple[str, Labels], Histogram]], List[Tuple[Tuple[str, Labels], Counter]]]:
+        with self._lock:
+            return sorted(self._histograms.items(), key=lambda item: item[0]), \
+                   sorted(self._counters.items(), key=lambda item: item[0])
+
+    def render_text(self) -> str:
+        """
+        Short human readable summary (/stats), quantiles are bucket upper bounds
+        """
+        histograms, counters = self._items()
+        lines = []
+        for (name, labels), hist in histograms:
+            _, total, count = hist.snapshot()
+            if not count:
+                continue
+            lines.append(f"{name}{_format_labels(labels)}: n={count} avg={total / count * 1000:.2f}ms "
+                         f"p50<={hist.quantile(0.5) * 1000:g}ms p99<={hist.quantile(0.99) * 1000:g}ms")
+        for (name, labels), counter in counters:
+            lines.append(f"{name}{_format_labels(labels)}: {counter.value:g}")
+        return "\n".join(lines) if lines else "No stats yet"
+
+    def render_prometheus(self) -> str:
+        histograms, counters = self._items()
+        lines = []
+        typed = set()
+        for (name, labels), hist in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            counts, total, count = hist.snapshot()
+            cumulative = 0
+            for bound, bucket_count in zip(hist.bounds + (float("inf"), ), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{name}_bucket{_format_labels(labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        for (name, labels), counter in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {counter.value:g}")
+        return "\n".join(lines) + "\n"
+
+
+@dataclass
+class MetricsServer:
+    """
+    Prometheus text endpoint (GET /metrics) on its own daemon thread
+    """
+    registry: StatsRegistry
+    port: int = 9100
+    host: str = "127.0.0.1"
+    _server: Optional[ThreadingHTTPServer] = field(init=False, default=None)
+    _thread: Optional[threading.Thread] = field(init=False, default=None)
+
+    def start(self) -> None:
+        if self._server is not None:
+            return
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # every scrape in bot_logs would be just noise
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="MetricsServer", daemon=True)
+        self._thread.start()
+        bot_logger.info(f"[MetricsServer] serving on http://{self.host}:{self.port}/metrics")
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server, self._thread = None, None
+
+
+stats = StatsRegistry()
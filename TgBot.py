@@ -1,13 +1,24 @@
-from typing import List
-from time import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from collections import defaultdict
 from dataclasses import dataclass, field
+from time import perf_counter, time
+from urllib.parse import urlparse
+import functools
+import gc
+import signal
 import threading
 import telebot
 from telebot import types
 from telebot.types import Message, CallbackQuery
 
-from MocneBoty.BotLogger import bot_logger
-from MocneBoty.WorkScheduleWebcam import WorkScheduleWebcam
+from MocneBoty.Admission import Admission, AdmissionController, ScheduleLimits
+from MocneBoty.BotLogger import bot_logger, log_ids
+from MocneBoty.MessageQueue import MessageQueue
+from MocneBoty.PresenceLog import PresenceRecorder, PresenceStore
+from MocneBoty.Scheduler import TimerScheduler
+from MocneBoty.ScheduleStore import ScheduleStore
+from MocneBoty.Stats import MetricsServer, stats
+from MocneBoty.WebhookServer import UpdateDispatcher, WebhookServer
 
 
 @dataclass(frozen=True)
@@ -19,226 +30,607 @@ class ThreadData:
     repeat: int
 
 
+ALL_COMMANDS_STR = "Commands: \n" \
+                   "  ~ /webcam <workTimeSecs:int> <breakTimeSecs:int> <Repeat:int>\n" \
+                   "  ~ /regular <workTimeSecsint> <breakTimeSecs:int> <Repeat:int>\n" \
+                   "  ~ /listThreads\n" \
+                   "  ~ /stopThread <thrId:int>\n" \
+                   "  ~ /snapshot [thrId:int]\n" \
+                   "  ~ /report [day|week]\n"
+
+
+def parse_schedule_params(command_text: str) -> Tuple[List[int], str]:
+    """
+    Parses /webcam and /regular params
+    :return: ([work_time, break_time, repeat], "") or ([], error msg for the user), error msg is empty when there
+    were no params at all
+    """
+    command, *command_params = command_text.split()
+    for ind, param in enumerate(command_params):
+        if not param.isdigit():
+            return [], "All values should be numeric"
+        command_params[ind] = int(param)
+
+    if not command_params:
+        return [], ""
+    if not 1 < len(command_params) < 4:
+        return [], "This command takes 2-3 arguments"
+
+    params = [1, 1, 1]
+    for ind, param in enumerate(command_params):
+        params[ind] = param
+    return params, ""
+
+
+def start_menu_markup() -> types.InlineKeyboardMarkup:
+    markup = types.InlineKeyboardMarkup(row_width=2)
+
+    webcam_sched = types.InlineKeyboardButton("Webcam", callback_data="webcam")
+    regular_sched = types.InlineKeyboardButton("Regular", callback_data="regular")
+    thread_options = types.InlineKeyboardButton("Threads", callback_data="threads")
+    all_commands = types.InlineKeyboardButton("All commands", callback_data="all_commands")
+
+    markup.add(webcam_sched, regular_sched, thread_options, all_commands)
+    return markup
+
+
+def threads_menu_markup() -> types.InlineKeyboardMarkup:
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    next_button1 = types.InlineKeyboardButton("List threads", callback_data="list_threads")
+    next_button2 = types.InlineKeyboardButton("Kill thread", callback_data="kill_thread")
+    markup.add(next_button1, next_button2)
+    return markup
+
+
+_CANCEL_LOCK = threading.Lock()
+
+
+@dataclass
+class ScheduleEntry:
+    """
+    Registry record of one schedule, thread_id is stable for the whole life of the schedule
+    """
+    thread_id: int
+    chat_id: int
+    task_name: str
+    data: ThreadData
+    phase: str = "work"
+    repeat_count: int = 0
+    deadline: Optional[float] = None  # unix time of next transition, None if it's not known (webcam)
+    timer_id: Optional[int] = None
+    shard: int = 0  # index of TimerScheduler the schedule's timers go to
+    _cancelled: bool = False
+    # Event is created only when someone waits for it (webcam loop), timer based schedules just check the flag
+    _cancel_event: Optional[threading.Event] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    @property
+    def cancel_event(self) -> threading.Event:
+        with _CANCEL_LOCK:
+            if self._cancel_event is None:
+                self._cancel_event = threading.Event()
+                if self._cancelled:
+                    self._cancel_event.set()
+            return self._cancel_event
+
+    def cancel(self) -> None:
+        with _CANCEL_LOCK:
+            self._cancelled = True
+            if self._cancel_event is not None:
+                self._cancel_event.set()
+
+    def to_row(self) -> Dict[str, Any]:
+        return {"thread_id": self.thread_id, "chat_id": self.chat_id, "task_name": self.task_name,
+                "work_time": self.data.work_time, "break_time": self.data.break_time, "repeat": self.data.repeat,
+                "phase": self.phase, "repeat_count": self.repeat_count, "deadline": self.deadline}
+
+
 @dataclass
 class ThreadsHandler:
-    _threads_status: List[ThreadData] = field(default_factory=lambda: [])
+    _threads_status: Dict[int, ScheduleEntry] = field(default_factory=dict)
+    _chat_threads: Dict[int, Set[int]] = field(default_factory=lambda: defaultdict(set))
+    _next_id: int = 0
+    _lock: threading.RLock = field(default_factory=threading.RLock)
+    scheduler: TimerScheduler = field(default_factory=TimerScheduler)
+    store: Optional[ScheduleStore] = None
+    limits: ScheduleLimits = field(default_factory=ScheduleLimits)
+    scheduler_shards: int = 1  # > 1 = timers are split between that many scheduler threads, by chat
+    admission: AdmissionController = field(init=False)
+    schedulers: List[TimerScheduler] = field(init=False)  # self.scheduler is the first one
+    _chat_shard: Dict[int, int] = field(init=False, default_factory=dict)
+    _shard_load: List[int] = field(init=False)  # schedules per shard
+
+    def __post_init__(self) -> None:
+        self.admission = AdmissionController(limits=self.limits)
+        self.schedulers = [self.scheduler] + [TimerScheduler(clock=self.scheduler.clock, name=f"TimerScheduler-{ind}")
+                                              for ind in range(1, self.scheduler_shards)]
+        self._shard_load = [0] * len(self.schedulers)
 
     @property
-    def threads_status(self) -> List[ThreadData]:
+    def threads_status(self) -> Dict[int, ScheduleEntry]:
         return self._threads_status
 
-    def create_thread(self, thread_id: int, func, work_time: int, break_time: int, chat_id: int, task_name: str,
-                      repeat: int = 1):
-        thread = threading.Thread(target=func, args=(thread_id, work_time, break_time, repeat, chat_id))
-        self._threads_status.append(ThreadData(name=f"{task_name}-{thread_id}",
-                                               running=False,
-                                               work_time=work_time,
-                                               break_time=break_time,
-                                               repeat=repeat))
-        thread.start()
-        bot_logger.info(f"[Create thread - {chat_id}] thread: {thread_id} started")
-
-    def stop_thread(self, thread_id: int) -> bool:
-        try:
-            self._threads_status.pop(thread_id)
-            return True
-        except IndexError:
-            return False
+    def get_thread(self, thread_id: int) -> Optional[ScheduleEntry]:
+        return self._threads_status.get(thread_id)
+
+    def chat_threads(self, chat_id: int) -> List[ScheduleEntry]:
+        with self._lock:
+            return [self._threads_status[thread_id] for thread_id in sorted(self._chat_threads.get(chat_id, ()))]
+
+    def register_thread(self, work_time: int, break_time: int, chat_id: int, task_name: str,
+                        repeat: int = 1, restored: Optional[Dict[str, Any]] = None) -> ScheduleEntry:
+        """
+        Adds schedule to the registry without starting anything
+        :param restored: row from ScheduleStore, schedule keeps its id and progress then
+        """
+        with self._lock:
+            if restored is None:
+                thread_id = self._next_id
+            else:
+                thread_id = restored["thread_id"]
+            self._next_id = max(self._next_id, thread_id + 1)
+
+            entry = ScheduleEntry(thread_id=thread_id,
+                                  chat_id=chat_id,
+                                  task_name=task_name,
+                                  data=ThreadData(name=f"{task_name}-{thread_id}",
+                                                  running=False,
+                                                  work_time=work_time,
+                                                  break_time=break_time,
+                                                  repeat=repeat))
+            if restored is not None:
+                entry.phase, entry.repeat_count = restored["phase"], restored["repeat_count"]
+                entry.deadline = restored["deadline"]
+            entry.shard = self._assign_shard(chat_id)
+            self._threads_status[thread_id] = entry
+            self._chat_threads[chat_id].add(thread_id)
+
+        if restored is None:
+            self.persist(entry)
+        return entry
+
+    def register_restored(self, rows: List[Tuple]) -> List[ScheduleEntry]:
+        """
+        register_thread for ScheduleStore.load_rows() tuples, all under one lock (restart with a lot of schedules)
+        """
+        entries = []
+        with self._lock:
+            for thread_id, chat_id, task_name, work_time, break_time, repeat, phase, repeat_count, deadline in rows:
+                entry = ScheduleEntry(thread_id, chat_id, task_name,
+                                      ThreadData(f"{task_name}-{thread_id}", False, work_time, break_time, repeat),
+                                      phase, repeat_count, deadline)
+                entry.shard = self._assign_shard(chat_id)
+                self._threads_status[thread_id] = entry
+                self._chat_threads[chat_id].add(thread_id)
+                entries.append(entry)
+            if entries:
+                self._next_id = max(self._next_id, max(entry.thread_id for entry in entries) + 1)
+        return entries
+
+    def _assign_shard(self, chat_id: int) -> int:
+        # must be called with self._lock held. All schedules of a chat share one shard, new chat goes to
+        # the least loaded one, so a chat with a lot of transitions only delays itself and chats on the same shard
+        shard = self._chat_shard.get(chat_id)
+        if shard is None:
+            shard = self._chat_shard[chat_id] = 0 if len(self.schedulers) == 1 else \
+                min(range(len(self.schedulers)), key=self._shard_load.__getitem__)
+        self._shard_load[shard] += 1
+        return shard
+
+    def persist(self, entry: ScheduleEntry) -> None:
+        if self.store is None:
+            return
+        # checked and queued under registry lock, stop_thread cancels under it too and queues delete after,
+        # so a save can't land behind the delete and bring stopped schedule back on restart
+        with self._lock:
+            if not entry.cancelled:
+                self.store.save(entry.to_row())
+
+    def admit_thread(self, start: Callable[[ScheduleEntry], None], work_time: int, break_time: int, chat_id: int,
+                     task_name: str, repeat: int = 1) -> Tuple[Admission, str]:
+        """
+        New schedule goes through self.admission (see ScheduleLimits), rejected one is not registered at all,
+        queued one is registered (visible in /listThreads, can be stopped) and started when it gets a slot
+        :param start: starts registered schedule
+        :return: verdict and message for the user (empty when started)
+        """
+        with self._lock:
+            # id is known before registering, so admission can hold it while schedule waits
+            thread_id = self._next_id
+            verdict, message = self.admission.admit(thread_id, chat_id, task_name,
+                                                    start=lambda: self._start_admitted(start, thread_id))
+            if verdict is Admission.REJECTED:
+                bot_logger.info(f"[Admission - {chat_id}] {task_name} rejected: {message}", extra=log_ids(chat_id))
+                return verdict, message
+            self.register_thread(work_time=work_time, break_time=break_time, chat_id=chat_id,
+                                 task_name=task_name, repeat=repeat)
+        if verdict is Admission.STARTED:
+            self._start_admitted(start, thread_id)
+        else:
+            bot_logger.info(f"[Admission - {chat_id}] thread: {thread_id} queued", extra=log_ids(chat_id, thread_id))
+        return verdict, message
+
+    def _start_admitted(self, start: Callable[[ScheduleEntry], None], thread_id: int) -> None:
+        # lock = waits until admit_thread registers the schedule, queued one can get its slot before that
+        with self._lock:
+            entry = self.get_thread(thread_id)
+        if entry is not None:
+            start(entry)
+
+    def create_thread(self, func, work_time: int, break_time: int, chat_id: int, task_name: str,
+                      repeat: int = 1, threaded: bool = True) -> Tuple[Admission, str]:
+        """
+        :param threaded: if False func is called directly, it's meant for timer based schedules which only
+        register their deadlines in self.schedulers and return
+        :return: verdict and message for the user, see admit_thread
+        """
+        def start(entry: ScheduleEntry) -> None:
+            thread_id = entry.thread_id
+            if threaded:
+                thread = threading.Thread(target=func, args=(thread_id, work_time, break_time, repeat, chat_id))
+                thread.start()
+            else:
+                self.schedulers[entry.shard].start()
+                func(thread_id, work_time, break_time, repeat, chat_id)
+            bot_logger.info(f"[Create thread - {chat_id}] thread: {thread_id} started",
+                            extra=log_ids(chat_id, thread_id))
+
+        return self.admit_thread(start, work_time=work_time, break_time=break_time, chat_id=chat_id,
+                                 task_name=task_name, repeat=repeat)
+
+    def schedule_timer(self, entry: ScheduleEntry, delay: float, callback: Callable, on_cancel: Callable,
+                       persist: bool = True) -> bool:
+        """
+        Arms next transition of the schedule, done under registry lock so it can't race with stop_thread
+        :param persist: new phase/deadline is saved to self.store (not needed when resuming restored schedule)
+        :return: False if schedule has been already stopped (timer is not created then)
+        """
+        with self._lock:
+            if entry.cancelled:
+                return False
+            entry.deadline = time() + delay
+            entry.timer_id = self.schedulers[entry.shard].call_later(delay, callback, on_cancel=on_cancel)
+        if persist:
+            self.persist(entry)
+        return True
+
+    def stop_thread(self, thread_id: int, chat_id: Optional[int] = None) -> bool:
+        """
+        :param chat_id: if given schedule is stopped only if it belongs to this chat
+        """
+        with self._lock:
+            entry = self._threads_status.get(thread_id)
+            if entry is None or (chat_id is not None and entry.chat_id != chat_id):
+                return False
+
+            del self._threads_status[thread_id]
+            chat_threads = self._chat_threads[entry.chat_id]
+            chat_threads.discard(thread_id)
+            if not chat_threads:
+                del self._chat_threads[entry.chat_id]
+                del self._chat_shard[entry.chat_id]
+            self._shard_load[entry.shard] -= 1
+
+            entry.cancel()
+            if entry.timer_id is not None:
+                self.schedulers[entry.shard].cancel(entry.timer_id)
+        if self.store is not None:
+            self.store.delete(thread_id)
+        # outside of registry lock, freed slot may start queued schedule right here
+        self.admission.release(thread_id)
+        return True
+
+    def list_threads(self, chat_id: Optional[int] = None) -> str:
+        if chat_id is None:
+            with self._lock:
+                entries = list(self._threads_status.values())
+        else:
+            entries = self.chat_threads(chat_id)
 
-    def list_threads(self) -> str:
         list_threads_str = "Running threads: \n"
-        for ind, thread in enumerate(self._threads_status):
-            list_threads_str += f"  [{ind}] - {thread}\n"
+        for entry in entries:
+            phase = "queued" if self.admission.is_waiting(entry.thread_id) else entry.phase
+            list_threads_str += f"  [{entry.thread_id}] - {entry.data} phase={phase}\n"
 
         return list_threads_str
 
+    def stats_report(self) -> str:
+        timers = ", ".join(str(len(scheduler)) for scheduler in self.schedulers)
+        report = f"Schedules: {len(self._threads_status)}, pending timers: {timers}\n" \
+                 f"{self.admission.report()}\n{stats.render_text()}"
+        # telegram won't take more than 4096 characters in one message
+        return report if len(report) <= 4000 else report[:4000] + "\n..."
+
 
 @dataclass
 class TelegramBot(ThreadsHandler):
     bot_token: str = ""
+    store_path: str = "schedules.db"  # empty string = schedules are not persisted
+    presence_path: str = "presence.db"  # webcam presence history for /report, empty string = not recorded
+    inference_workers: int = 0  # > 0 = webcam face inference runs in that many worker processes
+    client: Optional[Any] = None  # TeleBot compatible object used instead of real api (e.g. benchmarks' FakeTeleBot)
+    admin_chat_ids: Tuple[int, ...] = ()  # chats allowed to use /stats
+    metrics_port: int = 0  # > 0 = prometheus metrics on http://127.0.0.1:<port>/metrics
+    webhook_url: str = ""  # public https url telegram posts to, if set webhook mode is used instead of polling
+    webhook_host: str = "0.0.0.0"
+    webhook_port: int = 8443
+    webhook_secret: str = ""
+    update_workers: int = 8  # webhook mode, chats handled in parallel
+    update_queue: int = 1000  # webhook mode, accepted but not handled updates, telegram gets 429 above that
+    preload_vision: bool = False  # load cv2/mediapipe in background at start instead of on first /webcam
+    prewarm_detectors: int = 0  # > 0 = also build that many ready face detectors in background at start
+    webcam_headless: bool = False  # True = no preview window, frames are only analysed (/snapshot still works)
+    webcam_preview_fps: float = 5  # preview window refresh rate when not headless, 0 = every frame
+    _webcams: Dict[int, Any] = field(init=False, default_factory=dict)  # thread id -> running WorkScheduleWebcam
 
     def __post_init__(self) -> None:
-        self.bot = telebot.TeleBot(self.bot_token)
+        super().__post_init__()
+        # in webhook mode handlers run on UpdateDispatcher workers, telebot's own pool would break per chat order
+        self.bot = self.client if self.client is not None else \
+            telebot.TeleBot(self.bot_token, threaded=not self.webhook_url)
+        if self.store is None and self.store_path:
+            self.store = ScheduleStore(db_path=self.store_path)
+        self.presence_store = PresenceStore(db_path=self.presence_path) if self.presence_path else None
+        # schedule notifications go through the queue so slow/limited api calls don't shift schedule timing
+        self.outbox = MessageQueue(bot=self.bot)
+
+    def stats_report(self) -> str:
+        return f"Outbox depth: {self.outbox.depth()}\n{super().stats_report()}"
 
     def regular_schedule(self, thread_id: int, work_time: int, break_time: int, repeat: int, chat_id: int):
         """
+        Doesn't block, every work/break transition is a timer in chat's shard of self.schedulers
         :param thread_id:
-        :param work_time: minutes
-        :param break_time: minutes
+        :param work_time: seconds
+        :param break_time: seconds
         :param repeat:
         :param chat_id:
         :return:
         """
         call_params = f"{thread_id=}, {work_time=}, {break_time=}, {repeat=}"
-        bot_logger.info(f"[Regular Scheduler - {chat_id}] start: {call_params}")
-        stopped = False
-        repeat_count = 0
-
-        self.bot.send_message(chat_id, f"Let's start work")
-        while repeat_count < repeat or not repeat:
-            work_start_time = time()
+        bot_logger.info(f"[Regular Scheduler - {chat_id}] start: {call_params}", extra=log_ids(chat_id, thread_id))
+
+        entry = self.get_thread(thread_id)
+        if entry is None:
+            return
+        self.outbox.send_message(chat_id, f"Let's start work")
+        self._arm_regular(entry)
+
+    def _regular_stopped(self, entry: ScheduleEntry) -> None:
+        thread_id, chat_id = entry.thread_id, entry.chat_id
+        self.outbox.send_message(chat_id, f"Thread {thread_id} (regular schedule) has been finished")
+        bot_logger.info(f"[Regular Scheduler - {chat_id}] stop: {thread_id=}, work_time={entry.data.work_time}, "
+                        f"break_time={entry.data.break_time}, repeat={entry.data.repeat}",
+                        extra=log_ids(chat_id, thread_id))
+
+    def _arm_regular(self, entry: ScheduleEntry, resume_delay: Optional[float] = None) -> None:
+        """
+        Sets up timer chain of regular schedule starting from entry.phase
+        :param resume_delay: time left of the current phase (restored schedules), full phase length if None
+        """
+        thread_id, chat_id = entry.thread_id, entry.chat_id
+        work_time, break_time, repeat = entry.data.work_time, entry.data.break_time, entry.data.repeat
+        status_key = f"schedule-{thread_id}"
+
+        def call_params() -> str:
+            return f"{thread_id=}, {work_time=}, {break_time=}, {repeat=}"
+
+        def stopped():
+            self._regular_stopped(entry)
+
+        def next_phase(phase: str, delay: float, callback: Callable, persist: bool = True):
+            entry.phase = phase
+            if not self.schedule_timer(entry, delay, callback, on_cancel=stopped, persist=persist):
+                stopped()
+
+        def work_finished():
+            self.outbox.send_message(chat_id, f"{entry.repeat_count+1}/{repeat} work finished, time for a break!",
+                                     coalesce_key=status_key)
+            bot_logger.info(f"[Regular Scheduler - {chat_id}] work time finished {entry.repeat_count+1}/{repeat}: "
+                            f"{call_params()}", extra=log_ids(chat_id, thread_id))
+            next_phase("break", break_time, break_finished)
+
+        def break_finished():
+            if entry.repeat_count < repeat-1 or not repeat:
+                self.outbox.send_message(chat_id, f"{entry.repeat_count+1}/{repeat} break finished, "
+                                                  f"it's time to get back to work :/", coalesce_key=status_key)
+                bot_logger.info(f"[Regular Scheduler - {chat_id}] break time finished {entry.repeat_count+1}/{repeat}: "
+                                f"{call_params()}", extra=log_ids(chat_id, thread_id))
+            entry.repeat_count += 1
+
+            if entry.repeat_count < repeat or not repeat:
+                next_phase("work", work_time, work_finished)
+            else:
+                self.stop_thread(thread_id=thread_id)
+                stopped()
 
-            # yeah 2 whiles - i think it's more readable than 1 big while, performance difference should not be visible,
-            # cmon nothing fancy happening here lol
-
-            while (time() - work_start_time) < work_time:
-                try:
-                    self._threads_status[thread_id].running
-                except IndexError:
-                    stopped = True
-                    break
-            if not stopped:
-                self.bot.send_message(chat_id, f"{repeat_count+1}/{repeat} work finished, time for a break!")
-                bot_logger.info(f"[Regular Scheduler - {chat_id}] work time finished {repeat_count+1}/{repeat}: {call_params}")
-
-            break_start_time = time()
-            while (time() - break_start_time) < break_time:
-                try:
-                    self._threads_status[thread_id].running
-                except IndexError:
-                    stopped = True
-                    break
-            if not stopped and (repeat_count < repeat-1 or not repeat):
-                print(repeat_count, repeat)
-                self.bot.send_message(chat_id, f"{repeat_count+1}/{repeat} break finished, it's time to get back to work :/")
-                bot_logger.info(f"[Regular Scheduler - {chat_id}] break time finished {repeat_count+1}/{repeat}: {call_params}")
-            repeat_count += 1
-
-        self.stop_thread(thread_id=thread_id)
-        self.bot.send_message(chat_id, f"Thread {thread_id} (regular schedule) has been finished")
-        bot_logger.info(f"[Regular Scheduler - {chat_id}] stop: {call_params}")
+        if entry.phase == "break":
+            next_phase("break", break_time if resume_delay is None else resume_delay, break_finished,
+                       persist=resume_delay is None)
+        else:
+            next_phase("work", work_time if resume_delay is None else resume_delay, work_finished,
+                       persist=resume_delay is None)
 
     def webcam_bullshit(self, thread_id: int, work_time: int, break_time: int, repeat, chat_id):
         call_params = f"{thread_id=}, {work_time=}, {break_time=}, {repeat=}"
-        bot_logger.info(f"[Webcam Scheduler - {chat_id}] start: {call_params}")
-        wsw = WorkScheduleWebcam(
-            max_faces=1,
-            device_id=0,
-            work_time=work_time,
-            break_time=break_time,
-            repeat=repeat
-        )
-        wsw.run(bot=self.bot, chat_id=chat_id)
-        self.stop_thread(thread_id=thread_id)
-        self.bot.send_message(chat_id, f"Thread {thread_id} (webcam schedule) has been finished")
-        bot_logger.info(f"[Webcam Scheduler - {chat_id}] stopped: {call_params}")
+        bot_logger.info(f"[Webcam Scheduler - {chat_id}] start: {call_params}", extra=log_ids(chat_id, thread_id))
+        presence = None
+        # import and camera setup are inside too, broken vision stack must not leave the schedule (registry,
+        # admission slot, stored row) behind
+        try:
+            # cv2/mediapipe are loaded with the first webcam schedule, text only bot never pays for them
+            from MocneBoty.WorkScheduleWebcam import WorkScheduleWebcam, States, DetectionPolicy
+
+            wsw = WorkScheduleWebcam(
+                max_faces=1,
+                device_id=0,
+                work_time=work_time,
+                break_time=break_time,
+                repeat=repeat,
+                policy=DetectionPolicy.presence_only(),
+                shared=True,
+                headless=self.webcam_headless,
+                preview_fps=self.webcam_preview_fps
+            )
+            entry = self.get_thread(thread_id)
+            if entry is not None:
+                self._webcams[thread_id] = wsw
+                presence = PresenceRecorder(store=self.presence_store, chat_id=chat_id, schedule_id=thread_id) \
+                    if self.presence_store is not None else None
+
+                def on_transition(state: States, repeat_count: int):
+                    entry.phase, entry.repeat_count = state.value, repeat_count
+                    self.persist(entry)
+
+                # restored schedule continues from saved phase/repeat, new one has defaults (work, 0)
+                wsw.run(bot=self.outbox, chat_id=chat_id, stop_event=entry.cancel_event,
+                        status_key=f"schedule-{thread_id}", state=States(entry.phase),
+                        repeat_count=entry.repeat_count, on_transition=on_transition, presence=presence)
+        except Exception as e:
+            self.outbox.send_message(chat_id, f"Something went wrong: {e}")
+            bot_logger.error(f"[Webcam Scheduler - {chat_id}] {call_params}, error: {e}",
+                             extra=log_ids(chat_id, thread_id))
+        finally:
+            self._webcams.pop(thread_id, None)
+            if presence is not None:
+                presence.close()
+            self.stop_thread(thread_id=thread_id)
+        self.outbox.send_message(chat_id, f"Thread {thread_id} (webcam schedule) has been finished")
+        bot_logger.info(f"[Webcam Scheduler - {chat_id}] stopped: {call_params}", extra=log_ids(chat_id, thread_id))
+
+    def presence_report(self, chat_id: int, period: str = "day") -> str:
+        """
+        :param period: see PresenceStore.report
+        """
+        if self.presence_store is None:
+            return "Presence is not recorded on this bot"
+        return self.presence_store.report(chat_id, period)
 
     def setup_handlers(self) -> None:
         @self.bot.message_handler(commands=["start"])
+        @stats.timed("handler_seconds", command="start")
         def start_command(message: Message):
-            markup = types.InlineKeyboardMarkup(row_width=2)
-
-            webcam_sched = types.InlineKeyboardButton("Webcam", callback_data="webcam")
-            regular_sched = types.InlineKeyboardButton("Regular", callback_data="regular")
-            thread_options = types.InlineKeyboardButton("Threads", callback_data="threads")
-            all_commands = types.InlineKeyboardButton("All commands", callback_data="all_commands")
-
-            markup.add(webcam_sched, regular_sched, thread_options, all_commands)
-
             self.bot.send_message(message.chat.id,
                                   "<strong>Turbo menu</strong>",
-                                  reply_markup=markup,
+                                  reply_markup=start_menu_markup(),
                                   parse_mode="html")
 
         @self.bot.message_handler(commands=["webcam"])
+        @stats.timed("handler_seconds", command="webcam")
         def webcam_sched_command(message: Message):
-            command_text = message.text
-            command, *command_params = command_text.split()
-
-            bot_logger.info(f"[webcam_sched_command - {message.chat.id}] params raw: {command_params}")
-            for ind, param in enumerate(command_params):
-                if not param.isdigit():
-                    self.bot.send_message(message.chat.id, f"All values should be numeric")
-                    command_params = []
-                    break
-                else:
-                    command_params[ind] = int(param)
-
-            if command_params:
-                params = [1, 1, 1]
-                if 1 < len(command_params) < 4:
-                    for ind, param in enumerate(command_params):
-                        params[ind] = param
-
-                    work_time, break_time, repeat = params
-                    try:
-                        self.bot.send_message(message.chat.id, f"Started")
-                        self.create_thread(len(self._threads_status), self.webcam_bullshit, work_time=work_time,
-                                           break_time=break_time, repeat=repeat, chat_id=message.chat.id, task_name="Webcam")
-                    except Exception as e:
-                        self.bot.send_message(message.chat.id, f"Something went wrong: {e}")
-                        bot_logger.error(f"[webcam_sched_command - {message.chat.id}] params: {params},"
-                                              f" error: {e}")
-                else:
-                    self.bot.send_message(message.chat.id, f"This command takes 2-3 arguments")
+            bot_logger.info(f"[webcam_sched_command - {message.chat.id}] params raw: {message.text.split()[1:]}",
+                            extra=log_ids(chat_id=message.chat.id))
+            params, error = parse_schedule_params(message.text)
+            if error:
+                self.bot.send_message(message.chat.id, error)
+
+            if params:
+                work_time, break_time, repeat = params
+                try:
+                    _, reply = self.create_thread(self.webcam_bullshit, work_time=work_time, break_time=break_time,
+                                                  repeat=repeat, chat_id=message.chat.id, task_name="Webcam")
+                    self.bot.send_message(message.chat.id, reply or f"Started")
+                except Exception as e:
+                    self.bot.send_message(message.chat.id, f"Something went wrong: {e}")
+                    bot_logger.error(f"[webcam_sched_command - {message.chat.id}] params: {params},"
+                                     f" error: {e}", extra=log_ids(chat_id=message.chat.id))
 
         @self.bot.message_handler(commands=["regular"])
+        @stats.timed("handler_seconds", command="regular")
         def regular_sched_command(message: Message):
-            command_text = message.text
-            command, *command_params = command_text.split()
-            bot_logger.info(f"[regular_sched_command - {message.chat.id}] params raw: {command_params}")
-
-            for ind, param in enumerate(command_params):
-                if not param.isdigit():
-                    self.bot.send_message(message.chat.id, f"All values should be numeric")
-                    command_params = []
-                    break
-                else:
-                    command_params[ind] = int(param)
-
-            if command_params:
-                params = [1, 1, 1]
-                if 1 < len(command_params) < 4:
-                    for ind, param in enumerate(command_params):
-                        params[ind] = param
-
-                    work_time, break_time, repeat = params
-                    thread_names = [thread.name for thread in self._threads_status]
-
-                    try:
-                        if "Regular-0" not in thread_names:
-                            self.bot.send_message(message.chat.id, f"Started")
-                            self.create_thread(len(self._threads_status), self.regular_schedule, work_time=work_time,
-                                               break_time=break_time, repeat=repeat,
-                                               chat_id=message.chat.id, task_name="Regular")
-                        else:
-                            self.bot.send_message(message.chat.id, f"You can only run 1 regular work schedule at once. "
-                                                                   f"Stop current thread in order to make a new one.")
-                    except Exception as e:
-                        bot_logger.error(f"[regular_sched_command - {message.chat.id}] params: {params}, error: {e}")
-                        self.bot.send_message(message.chat.id, f"Something went wrong: {e}")
-                else:
-                    self.bot.send_message(message.chat.id, f"This command takes 2-3 arguments")
+            bot_logger.info(f"[regular_sched_command - {message.chat.id}] params raw: {message.text.split()[1:]}",
+                            extra=log_ids(chat_id=message.chat.id))
+            params, error = parse_schedule_params(message.text)
+            if error:
+                self.bot.send_message(message.chat.id, error)
+
+            if params:
+                work_time, break_time, repeat = params
+                try:
+                    # how many regular schedules a chat may run is up to self.limits
+                    _, reply = self.create_thread(self.regular_schedule, work_time=work_time,
+                                                  break_time=break_time, repeat=repeat,
+                                                  chat_id=message.chat.id, task_name="Regular", threaded=False)
+                    self.bot.send_message(message.chat.id, reply or f"Started")
+                except Exception as e:
+                    bot_logger.error(f"[regular_sched_command - {message.chat.id}] params: {params}, error: {e}",
+                                     extra=log_ids(chat_id=message.chat.id))
+                    self.bot.send_message(message.chat.id, f"Something went wrong: {e}")
 
         @self.bot.message_handler(commands=["stopThread"])
+        @stats.timed("handler_seconds", command="stopThread")
         def stop_thread_command(message: Message):
             command_text = message.text
             splitted = command_text.split()
 
-            bot_logger.info(f"[stopThread command - {message.chat.id}] params: {splitted}")
+            bot_logger.info(f"[stopThread command - {message.chat.id}] params: {splitted}",
+                            extra=log_ids(chat_id=message.chat.id))
 
             if len(splitted) == 2:
                 thread_id = splitted[1]
                 if thread_id.isdigit():
                     thread_id = int(thread_id)
-                    success = self.stop_thread(thread_id=thread_id)
+                    success = self.stop_thread(thread_id=thread_id, chat_id=message.chat.id)
                     if success:
                         self.bot.send_message(message.chat.id, f"Thread: {thread_id} has been stopped")
-                        bot_logger.info(f"[stopThread command - {message.chat.id}] Thread: {thread_id} has been stopped")
+                        bot_logger.info(f"[stopThread command - {message.chat.id}] Thread: {thread_id} has been stopped",
+                                        extra=log_ids(chat_id=message.chat.id, schedule_id=thread_id))
                     else:
                         self.bot.send_message(message.chat.id, f"Thread: {thread_id} was not stopped successfully")
-                        bot_logger.error(f"[stopThread command - {message.chat.id}] Thread: {thread_id} was not stopped successfully")
+                        bot_logger.error(f"[stopThread command - {message.chat.id}] Thread: {thread_id} was not stopped successfully",
+                                         extra=log_ids(chat_id=message.chat.id, schedule_id=thread_id))
                 else:
                     self.bot.send_message(message.chat.id, f"Thread id must be a digit")
             else:
                 self.bot.send_message(message.chat.id, f"This command takes 1 argument")
 
         @self.bot.message_handler(commands=["listThreads"])
+        @stats.timed("handler_seconds", command="listThreads")
         def list_threads_command(message: Message):
-            list_threads_str = self.list_threads()
+            list_threads_str = self.list_threads(chat_id=message.chat.id)
             self.bot.send_message(message.chat.id, list_threads_str)
 
+        @self.bot.message_handler(commands=["snapshot"])
+        @stats.timed("handler_seconds", command="snapshot")
+        def snapshot_command(message: Message):
+            # /snapshot = every running webcam schedule of the chat, /snapshot <thrId> = only that one
+            chat_id = message.chat.id
+            params = message.text.split()[1:]
+            webcams = [(entry.thread_id, self._webcams.get(entry.thread_id)) for entry in self.chat_threads(chat_id)
+                       if not params or str(entry.thread_id) == params[0]]
+            webcams = [(thread_id, wsw) for thread_id, wsw in webcams if wsw is not None]
+            if not webcams:
+                self.bot.send_message(chat_id, "No running webcam schedule")
+                return
+
+            for thread_id, wsw in webcams:
+                # rendered by the webcam loop with its next frame, sent through outbox from there
+                wsw.request_snapshot(lambda jpeg, thread_id=thread_id:
+                                     self.outbox.send_photo(chat_id, jpeg, caption=f"Thread {thread_id}"))
+
+        @self.bot.message_handler(commands=["report"])
+        @stats.timed("handler_seconds", command="report")
+        def report_command(message: Message):
+            params = message.text.split()[1:]
+            period = params[0] if params else "day"
+            if len(params) > 1 or period not in ("day", "week"):
+                self.bot.send_message(message.chat.id, "Usage: /report [day|week]")
+                return
+            self.bot.send_message(message.chat.id, self.presence_report(message.chat.id, period))
+
+        @self.bot.message_handler(commands=["stats"])
+        @stats.timed("handler_seconds", command="stats")
+        def stats_command(message: Message):
+            if message.chat.id not in self.admin_chat_ids:
+                self.bot.send_message(message.chat.id, "This command is only for bot admins")
+                return
+            self.bot.send_message(message.chat.id, self.stats_report())
+
         @self.bot.callback_query_handler(func=lambda call: True)
+        @stats.timed("handler_seconds", command="callback")
         def answer(callback: CallbackQuery):
             if callback.message:
                 if callback.data == "webcam":
@@ -248,15 +640,12 @@ class TelegramBot(ThreadsHandler):
                     self.bot.send_message(callback.message.chat.id, "run /regular <workTimeSecs> <breakTimeSecs> <Repeat>")
 
                 if callback.data == "threads":
-                    markup = types.InlineKeyboardMarkup(row_width=2)
-                    next_button1 = types.InlineKeyboardButton("List threads", callback_data="list_threads")
-                    next_button2 = types.InlineKeyboardButton("Kill thread", callback_data="kill_thread")
-                    markup.add(next_button1, next_button2)
                     self.bot.edit_message_text(chat_id=callback.message.chat.id, message_id=callback.message.message_id,
-                                               text="<strong>Threads menu</strong>", reply_markup=markup, parse_mode="html")
+                                               text="<strong>Threads menu</strong>", reply_markup=threads_menu_markup(),
+                                               parse_mode="html")
 
                 if callback.data == "list_threads":
-                    list_threads_str = self.list_threads()
+                    list_threads_str = self.list_threads(chat_id=callback.message.chat.id)
                     self.bot.send_message(callback.message.chat.id, list_threads_str)
                     self.bot.send_message(callback.message.chat.id, "run /listThreads")
 
@@ -264,18 +653,162 @@ class TelegramBot(ThreadsHandler):
                     self.bot.send_message(callback.message.chat.id, "run /stopThread <thrId>")
 
                 if callback.data == "all_commands":
-                    all_commands_str = "Commands: \n" \
-                                       "  ~ /webcam <workTimeSecs:int> <breakTimeSecs:int> <Repeat:int>\n"\
-                                       "  ~ /regular <workTimeSecsint> <breakTimeSecs:int> <Repeat:int>\n"\
-                                       "  ~ /listThreads\n"\
-                                       "  ~ /stopThread <thrId:int>\n"
-                    self.bot.send_message(callback.message.chat.id, all_commands_str)
+                    self.bot.send_message(callback.message.chat.id, ALL_COMMANDS_STR)
+
+    def restore_schedules(self) -> int:
+        """
+        Brings back schedules saved in self.store, regular ones continue with the time that was left
+        (or fire right away if deadline passed while bot was down)
+        :return: number of restored schedules
+        """
+        if self.store is None:
+            return 0
+        rows = self.store.load_rows()
+        if not rows:
+            return 0
+
+        now, clock_now = time(), self.scheduler.clock()
+        # bulk of long living objects, gc passes in the middle would only slow it down
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with self._lock:
+                entries = self.register_restored(rows)
+                # per chat limits don't apply (schedule was admitted before restart), global ones do
+                started = self.admission.admit_restored(
+                    [(entry.thread_id, entry.chat_id, entry.task_name) for entry in entries],
+                    start=lambda thread_id: self._start_admitted(lambda entry: self._resume(entry, time()), thread_id))
+
+                # regular schedule gets just one timer for the rest of its phase, pushed in bulk, the timer
+                # chain (_arm_regular closures) is built when it fires
+                timers: Dict[int, List[Tuple[ScheduleEntry, float]]] = defaultdict(list)
+                for thread_id in started:
+                    entry = self._threads_status[thread_id]
+                    if entry.task_name != "Regular":
+                        self._resume(entry, now)
+                        continue
+                    deadline = entry.deadline if entry.deadline is not None else now
+                    timers[entry.shard].append((entry, clock_now + max(0.0, deadline - now)))
+                for shard, shard_timers in timers.items():
+                    timer_ids = self.schedulers[shard].call_many(
+                        [(deadline, functools.partial(self._arm_regular, entry, 0.0),
+                          functools.partial(self._regular_stopped, entry)) for entry, deadline in shard_timers])
+                    for (entry, _), timer_id in zip(shard_timers, timer_ids):
+                        entry.timer_id = timer_id
+        finally:
+            gc.freeze()
+            if gc_enabled:
+                gc.enable()
+        # started after all timers are in, so it doesn't wake up for every pushed timer
+        for scheduler in self.schedulers:
+            scheduler.start()
+        bot_logger.info(f"[Restore] {len(rows)} schedules restored")
+        return len(rows)
+
+    def _resume(self, entry: ScheduleEntry, now: float) -> None:
+        if entry.task_name == "Regular":
+            deadline = entry.deadline if entry.deadline is not None else now
+            self._arm_regular(entry, resume_delay=max(0.0, deadline - now))
+        else:
+            thread = threading.Thread(target=self.webcam_bullshit,
+                                      args=(entry.thread_id, entry.data.work_time, entry.data.break_time,
+                                            entry.data.repeat, entry.chat_id))
+            thread.start()
+
+    def load_vision(self) -> None:
+        """
+        Imports vision stack and pre-warms detectors (prewarm_detectors), start() runs it in background thread
+        """
+        start = perf_counter()
+        from MocneBoty.CameraHub import camera_hub
+        from MocneBoty.WorkScheduleWebcam import DetectionPolicy
+        loaded = perf_counter()
+        if self.prewarm_detectors:
+            camera_hub.prewarm(self.prewarm_detectors, model=DetectionPolicy.presence_only().presence_model)
+        bot_logger.info(f"[Vision] imported in {loaded - start:.2f}s, detectors ready in "
+                        f"{perf_counter() - loaded:.2f}s")
 
     def start(self) -> None:
         bot_logger.info("Starting")
+        if self.preload_vision or self.prewarm_detectors:
+            threading.Thread(target=self.load_vision, name="VisionPreload", daemon=True).start()
+        if self.inference_workers:
+            from MocneBoty.CameraHub import camera_hub
+            camera_hub.use_inference_pool(self.inference_workers)
+        self.restore_schedules()
         self.setup_handlers()
         bot_logger.info("Handlers ready, should be all green :P")
-        self.bot.polling()
+        self.outbox.start()
+        if self.metrics_port:
+            MetricsServer(registry=stats, port=self.metrics_port).start()
+
+        stop_event = threading.Event()
+
+        def on_sigterm(signum, frame):
+            stop_event.set()
+            if not self.webhook_url:
+                self.bot.stop_polling()
+
+        try:
+            signal.signal(signal.SIGTERM, on_sigterm)
+        except ValueError:
+            pass  # not the main thread, ctrl+c / stop_event only
+
+        if not self.webhook_url:
+            try:
+                self.bot.polling()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self.shutdown()
+            return
+
+        server = self.start_webhook()
+        try:
+            while not stop_event.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.shutdown_webhook(server)
+
+    def start_webhook(self) -> WebhookServer:
+        """
+        Starts local http server + dispatcher and registers webhook_url in telegram, doesn't block
+        """
+        dispatcher = UpdateDispatcher(process=lambda update: self.bot.process_new_updates([update]),
+                                      workers=self.update_workers, max_pending=self.update_queue)
+        server = WebhookServer(dispatcher=dispatcher, host=self.webhook_host, port=self.webhook_port,
+                               path=urlparse(self.webhook_url).path or "/", secret_token=self.webhook_secret)
+        dispatcher.start()
+        server.start()
+        self.bot.set_webhook(url=self.webhook_url, secret_token=self.webhook_secret or None,
+                             max_connections=self.update_workers)
+        return server
+
+    def shutdown_webhook(self, server: WebhookServer, timeout: float = 30) -> None:
+        """
+        Graceful stop: no new updates, accepted ones are handled, queued messages and schedule writes go out.
+        Webhook stays registered, telegram keeps updates until the bot is back
+        """
+        server.stop(timeout)
+        self.shutdown(timeout)
+
+    def shutdown(self, timeout: float = 30) -> None:
+        """
+        Sends what is still queued and writes pending schedule/presence changes, both polling and webhook mode
+        end with it
+        """
+        bot_logger.info("Shutting down")
+        self.outbox.flush(timeout)
+        self.outbox.stop(timeout)
+        if self.store is not None:
+            self.store.stop()
+        if self.presence_store is not None:
+            self.presence_store.stop()
+        if self.inference_workers:
+            from MocneBoty.CameraHub import camera_hub
+            camera_hub.stop_inference_pool()
 
 
 if __name__ == '__main__':
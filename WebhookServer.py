@@ -0,0 +1,205 @@
+from collections import deque
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+import threading
+import telebot
+
+from MocneBoty.BotLogger import bot_logger
+from MocneBoty.Stats import stats
+
+
+def update_chat_id(update: Any) -> Optional[int]:
+    """
+    Chat the update belongs to, updates of the same chat are handled in order
+    """
+    for name in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        message = getattr(update, name, None)
+        if message is not None:
+            return message.chat.id
+    callback = getattr(update, "callback_query", None)
+    if callback is not None:
+        if callback.message is not None:
+            return callback.message.chat.id
+        return callback.from_user.id
+    return None
+
+
+@dataclass
+class UpdateDispatcher:
+    """
+    Bounded pool for incoming updates, different chats are handled in parallel, updates of one chat
+    one after another in the order they came (a chat is never on two workers at once)
+    """
+    process: Callable[[Any], None]
+    workers: int = 8
+    max_pending: int = 1000  # all chats together, submit is refused above that
+    max_per_chat: int = 100  # so one flooding chat can't take the whole queue
+    _chats: Dict[Any, Deque[Tuple[float, Any]]] = field(init=False, default_factory=dict)
+    _ready: Deque[Any] = field(init=False, default_factory=deque)  # chats with updates and no worker on them
+    _pending: int = field(init=False, default=0)
+    _cond: threading.Condition = field(init=False, default_factory=threading.Condition)
+    _threads: List[threading.Thread] = field(init=False, default_factory=list)
+    _accepting: bool = field(init=False, default=False)
+    _running: bool = field(init=False, default=False)
+
+    def start(self) -> None:
+        with self._cond:
+            if self._running:
+                return
+            self._running = self._accepting = True
+        for ind in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"UpdateWorker-{ind}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: Optional[float] = None) -> bool:
+        """
+        Stops taking new updates, already accepted ones are still handled (up to timeout)
+        :return: True if everything accepted was handled
+        """
+        with self._cond:
+            self._accepting = False
+            drained = self._cond.wait_for(lambda: self._pending == 0, timeout)
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        return drained
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def accepting(self) -> bool:
+        return self._accepting
+
+    def submit(self, update: Any, key: Any = None) -> bool:
+        """
+        :param key: ordering key (chat id), None = no ordering needed, update gets its own slot
+        :return: False if queue is full or dispatcher is stopping, caller should answer with retry later
+        """
+        with self._cond:
+            if not self._accepting or self._pending >= self.max_pending:
+                return False
+            if key is None:
+                key = object()
+            chat_queue = self._chats.get(key)
+            if chat_queue is None:
+                chat_queue = self._chats[key] = deque()
+                self._ready.append(key)
+            elif len(chat_queue) >= self.max_per_chat:
+                return False
+            chat_queue.append((monotonic(), update))
+            self._pending += 1
+            self._cond.notify()
+        return True
+
+    def _worker(self) -> None:
+        queue_wait = stats.histogram("webhook_queue_wait_seconds")
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._ready or not self._running)
+                if not self._running:
+                    return
+                key = self._ready.popleft()
+                enqueued_at, update = self._chats[key].popleft()
+            queue_wait.observe(monotonic() - enqueued_at)
+
+            try:
+                self.process(update)
+            except Exception as e:
+                bot_logger.error(f"[UpdateDispatcher] update failed: {e}")
+
+            with self._cond:
+                self._pending -= 1
+                if self._chats[key]:
+                    # back to the end of the line, other chats go first
+                    self._ready.append(key)
+                else:
+                    del self._chats[key]
+                self._cond.notify_all()
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    # default listen backlog is 5, telegram opens up to max_connections at once
+    request_queue_size = 128
+    daemon_threads = True
+
+
+@dataclass
+class WebhookServer:
+    """
+    Local HTTP endpoint telegram posts updates to (usually behind reverse proxy with TLS), answers right away,
+    handling happens in dispatcher. 429 when the queue is full, telegram retries the update later
+    """
+    dispatcher: UpdateDispatcher
+    host: str = "0.0.0.0"
+    port: int = 8443
+    path: str = "/webhook"
+    secret_token: str = ""  # compared with X-Telegram-Bot-Api-Secret-Token header if set
+    parse_update: Callable[[str], Any] = telebot.types.Update.de_json
+    _server: Optional[_HTTPServer] = field(init=False, default=None)
+    _thread: Optional[threading.Thread] = field(init=False, default=None)
+
+    def start(self) -> None:
+        if self._server is not None:
+            return
+        webhook = self
+        accepted = stats.counter("webhook_updates_total", result="accepted")
+        rejected = stats.counter("webhook_updates_total", result="rejected")
+
+        class Handler(BaseHTTPRequestHandler):
+            def _answer(self, code: int, headers: Optional[Dict[str, str]] = None) -> None:
+                self.send_response(code)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_POST(self):
+                if self.path.split("?")[0] != webhook.path:
+                    self._answer(404)
+                    return
+                if webhook.secret_token and \
+                        self.headers.get("X-Telegram-Bot-Api-Secret-Token") != webhook.secret_token:
+                    self._answer(403)
+                    return
+                try:
+                    body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+                    update = webhook.parse_update(body)
+                except (ValueError, KeyError) as e:
+                    bot_logger.error(f"[WebhookServer] bad update: {e}")
+                    self._answer(400)
+                    return
+
+                if webhook.dispatcher.submit(update, key=update_chat_id(update)):
+                    accepted.inc()
+                    self._answer(200)
+                else:
+                    rejected.inc()
+                    self._answer(429 if webhook.dispatcher.accepting else 503, {"Retry-After": "1"})
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _HTTPServer((self.host, self.port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="WebhookServer", daemon=True)
+        self._thread.start()
+        bot_logger.info(f"[WebhookServer] listening on {self.host}:{self.port}{self.path}")
+
+    def stop(self, timeout: Optional[float] = None) -> bool:
+        """
+        Stops listening first, then lets dispatcher finish what was already accepted
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server, self._thread = None, None
+        drained = self.dispatcher.stop(timeout)
+        bot_logger.info(f"[WebhookServer] stopped, {'all' if drained else 'not all'} accepted updates handled")
+        return drained
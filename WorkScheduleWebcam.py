@@ -1,13 +1,18 @@
+from collections import deque
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Tuple, Union
+from typing import Any, Callable, Iterator, Optional, Tuple, Union
 from time import time
+import threading
 import numpy as np
 import cv2
 import mediapipe as mp
 import telebot
 
 from MocneBoty.BotLogger import bot_logger
+from MocneBoty.FrameGrabber import CaptureFormat, FrameGrabber
+from MocneBoty.PresenceLog import PresenceRecorder
+from MocneBoty.Stats import stats
 
 
 class States(Enum):
@@ -15,6 +20,103 @@ class States(Enum):
     BREAK: str = "break"
 
 
+@dataclass
+class DetectionPolicy:
+    """
+    How often face inference really runs, between inferences last result is reused
+    """
+    every_n_frames: int = 1
+    target_hz: float = 0  # max inferences per second, 0 = no limit
+    motion_threshold: float = 0  # mean abs pixel diff (0-255) of small gray frame, below it inference is skipped
+    presence_model: str = "mesh"  # "mesh" (FaceMesh) or "detection" (lighter MediaPipe face detection)
+    tolerance: float = 1.0  # seconds, result is never older than this no matter what the rules above say
+    motion_size: Tuple[int, int] = (64, 48)
+    inference_width: int = 0  # wider frames are downscaled to this before inference, 0 = full resolution
+    roi_tracking: bool = False  # search only padded area around last face, full frame if it's not found there
+    roi_padding: float = 0.5  # part of face box size added on every side of the roi
+    roi_refresh: float = 5.0  # seconds, full frame search at least this often (new faces outside of roi)
+
+    @classmethod
+    def presence_only(cls) -> "DetectionPolicy":
+        """
+        Preset for the bot - nobody looks at the mesh there, only presence matters
+        """
+        return cls(target_hz=2, motion_threshold=2.0, presence_model="detection", inference_width=320,
+                   roi_tracking=True)
+
+
+@dataclass
+class PresenceSampler:
+    """
+    Applies DetectionPolicy frame by frame, keeps last result
+    """
+    policy: DetectionPolicy = field(default_factory=DetectionPolicy)
+    frame_count: int = 0
+    last_infer_time: float = float("-inf")
+    boxes: np.ndarray = field(default_factory=lambda: np.empty((0, 4), dtype=np.int32))
+    last_full_time: float = float("-inf")
+    _prev_small: Optional[np.ndarray] = None
+
+    def _moved(self, frame: np.ndarray) -> bool:
+        small = cv2.cvtColor(cv2.resize(frame, self.policy.motion_size, interpolation=cv2.INTER_AREA),
+                             cv2.COLOR_BGR2GRAY)
+        prev, self._prev_small = self._prev_small, small
+        if prev is None:
+            return True
+        return cv2.absdiff(small, prev).mean() >= self.policy.motion_threshold
+
+    def should_infer(self, frame: np.ndarray, now: float) -> bool:
+        policy = self.policy
+        self.frame_count += 1
+        if now - self.last_infer_time >= policy.tolerance:
+            if policy.motion_threshold > 0:
+                self._moved(frame)  # keep reference frame fresh
+            return True
+        if self.frame_count % max(policy.every_n_frames, 1):
+            return False
+        if policy.target_hz > 0 and now - self.last_infer_time < 1 / policy.target_hz:
+            return False
+        if policy.motion_threshold > 0 and not self._moved(frame):
+            return False
+        return True
+
+    def _roi(self, frame: np.ndarray) -> Optional[Tuple[int, int, int, int]]:
+        h, w = frame.shape[:2]
+        x1, y1 = self.boxes[:, :2].min(axis=0)
+        x2, y2 = self.boxes[:, 2:].max(axis=0)
+        pad_x, pad_y = int((x2 - x1) * self.policy.roi_padding), int((y2 - y1) * self.policy.roi_padding)
+        x1, y1 = max(0, int(x1) - pad_x), max(0, int(y1) - pad_y)
+        x2, y2 = min(w, int(x2) + pad_x), min(h, int(y2) + pad_y)
+        if x2 - x1 < 16 or y2 - y1 < 16:
+            return None
+        return x1, y1, x2, y2
+
+    def _detect(self, frame: np.ndarray, now: float, detect: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        policy = self.policy
+        if policy.roi_tracking and len(self.boxes) and now - self.last_full_time < policy.roi_refresh:
+            roi = self._roi(frame)
+            if roi is not None:
+                x1, y1, x2, y2 = roi
+                # view, no copy, boxes come back in roi coords
+                boxes = detect(frame[y1:y2, x1:x2])
+                if len(boxes):
+                    return boxes + np.array([x1, y1, x1, y1], dtype=np.int32)
+            # face left the roi (or tracking lost), whole frame has to be searched
+        self.last_full_time = now
+        return detect(frame)
+
+    def update(self, frame: np.ndarray, now: float, detect: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        """
+        :param detect: frame -> (n_faces, 4) boxes, called only when policy says so (with roi_tracking
+        it gets just a part of the frame)
+        :return: boxes from the latest inference
+        """
+        if self.should_infer(frame, now):
+            self.boxes = self._detect(frame, now, detect)
+            self.last_infer_time = now
+        return self.boxes
+
+
 @dataclass
 class FaceDetector:
     max_faces: int
@@ -28,35 +130,91 @@ class FaceDetector:
         self.face = self.mp_face.FaceMesh(max_num_faces=self.max_faces)
         self.mp_drawing = mp.solutions.drawing_utils
 
-    def get_lms(self, frame: np.array, draw_mesh: bool = False) -> List[List[Tuple[int, int]]]:
-        faces = []
+    def warm_up(self, model: str = "mesh") -> None:
+        """
+        One inference on empty frame, model graph gets built now instead of on the first real frame
+        """
+        self.get_boxes(np.zeros((480, 640, 3), dtype=np.uint8), model=model)
+
+    @staticmethod
+    def _inference_input(frame: np.ndarray, inference_width: int = 0) -> np.ndarray:
+        """
+        RGB copy for mediapipe, downscaled first (if wider than inference_width) so conversion touches less pixels
+        """
+        h, w = frame.shape[:2]
+        if inference_width and w > inference_width:
+            frame = cv2.resize(frame, (inference_width, max(1, round(h * inference_width / w))),
+                               interpolation=cv2.INTER_AREA)
+        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        rgb.flags.writeable = False
+        return rgb
+
+    def get_lms(self, frame: np.array, draw_mesh: bool = False, bbox_only: bool = False,
+                inference_width: int = 0) -> np.ndarray:
+        """
+        :param draw_mesh: mesh is drawn on frame
+        :param bbox_only: fill only landmarks used by draw_face_rect, rest of the array stays 0
+        :param inference_width: see DetectionPolicy.inference_width, coords are always in frame's pixels
+        :return: (n_faces, n_landmarks, 2) int32 array of pixel coords, n_landmarks is 468 for default FaceMesh
+        """
         h, w, _ = frame.shape
 
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        frame.flags.writeable = False
-        results = self.face.process(frame).multi_face_landmarks
-        frame.flags.writeable = True
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-        if results:
-            for landmark in results:
-                if draw_mesh:
-                    self.mp_drawing.draw_landmarks(frame, landmark, self.mp_face.FACEMESH_CONTOURS)
+        # landmarks are normalized, so nothing has to be converted back (neither colors nor scale)
+        results = self.face.process(self._inference_input(frame, inference_width)).multi_face_landmarks
+        if not results:
+            return np.empty((0, 468, 2), dtype=np.int32)
+
+        n_landmarks = len(results[0].landmark)
+        coords = np.zeros((len(results), n_landmarks, 2), dtype=np.float32)
+        for face_ind, landmark in enumerate(results):
+            if draw_mesh:
+                self.mp_drawing.draw_landmarks(frame, landmark, self.mp_face.FACEMESH_CONTOURS)
 
-                face_data = []
-                for ind, lm in enumerate(landmark.landmark):
-                    x, y = int(lm.x * w), int(lm.y * h)
-                    face_data.append((x, y))
-                faces.append(face_data)
+            lms = landmark.landmark
+            if bbox_only:
+                for ind in (self._left_point, self._right_point, self._top_point, self._bottom_point):
+                    coords[face_ind, ind] = lms[ind].x, lms[ind].y
+            else:
+                # reading x/y of proto messages is the only per landmark part, array is built in one go
+                coords[face_ind] = np.array([(lm.x, lm.y) for lm in lms], dtype=np.float32)
+
+        coords *= np.array([w, h], dtype=np.float32)
+        return coords.astype(np.int32)
+
+    def get_boxes(self, frame: np.array, model: str = "mesh", inference_width: int = 0) -> np.ndarray:
+        """
+        :param model: "mesh" - boxes from FaceMesh landmarks, "detection" - MediaPipe face detection which is
+        much cheaper when we only care if someone is there
+        :param inference_width: see DetectionPolicy.inference_width
+        :return: (n_faces, 4) int32 array of x1, y1, x2, y2 in frame's pixels
+        """
+        if model == "detection":
+            if getattr(self, "face_detection", None) is None:
+                self.face_detection = mp.solutions.face_detection.FaceDetection(model_selection=0)
+            h, w, _ = frame.shape
+            detections = self.face_detection.process(self._inference_input(frame, inference_width)).detections or []
+            boxes = np.zeros((min(len(detections), self.max_faces), 4), dtype=np.float32)
+            for ind, detection in enumerate(detections[:self.max_faces]):
+                box = detection.location_data.relative_bounding_box
+                boxes[ind] = box.xmin, box.ymin, box.xmin + box.width, box.ymin + box.height
+            return (boxes * np.array([w, h, w, h], dtype=np.float32)).astype(np.int32)
 
-        return faces
+        faces = self.get_lms(frame=frame, bbox_only=True, inference_width=inference_width)
+        return np.stack([faces[:, self._left_point, 0], faces[:, self._top_point, 1],
+                         faces[:, self._right_point, 0], faces[:, self._bottom_point, 1]], axis=1)
+
+    @staticmethod
+    def draw_box(frame: np.array, box: np.ndarray, color: Tuple[int, int, int] = (255, 0, 255)) -> None:
+        x1, y1, x2, y2 = (int(v) for v in box)
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 3)
 
     def draw_face_rect(self, frame: np.array,
-                       face_lm_list: List[Tuple[int, int]],
+                       face_lm_list: np.ndarray,
                        color: Tuple[int, int, int] = (255, 0, 255)) -> None:
 
         x1, y1 = face_lm_list[self._left_point][0], face_lm_list[self._top_point][1]
         x2, y2 = face_lm_list[self._right_point][0], face_lm_list[self._bottom_point][1]
-        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 3)
+        cv2.rectangle(frame, (int(x1), int(y1)), (int(x2), int(y2)), color, 3)
 
 
 @dataclass
@@ -65,9 +223,24 @@ class WorkScheduleWebcam(FaceDetector):
     work_time: int
     break_time: int
     repeat: int
+    policy: DetectionPolicy = field(default_factory=DetectionPolicy)
+    shared: bool = False  # use camera + detector owned by CameraHub instead of opening own ones
+    capture: Optional[Any] = None  # VideoCapture-like source used instead of device_id (e.g. recorded video)
+    capture_format: CaptureFormat = field(default_factory=CaptureFormat)  # resolution/fps of the camera
+    headless: bool = False  # no window, frames are drawn on only when snapshot is requested
+    preview_fps: float = 0  # window is redrawn at most this often, 0 = every frame
+    _snapshot_requests: deque = field(init=False, default_factory=deque)
 
     def __post_init__(self) -> None:
+        if self.shared:
+            # nothing to build here, hub already has (or will lazily open) the device and the model
+            self.cap = None
+            return
+
         super().__post_init__()
+        if self.capture is not None:
+            self.cap = self.capture
+            return
         available_devices = [0, 1, 2]
 
         self.cap = cv2.VideoCapture(self.device_id)
@@ -81,6 +254,8 @@ class WorkScheduleWebcam(FaceDetector):
                     if success:  # inform user that we're changing device id :P
                         bot_logger.info(f"Device found: {dev}")
                         break
+        if success:
+            self.capture_format.apply(self.cap)
 
     @staticmethod
     def change_format(seconds: int):
@@ -110,65 +285,176 @@ class WorkScheduleWebcam(FaceDetector):
                     (10, 120), cv2.FONT_HERSHEY_PLAIN, 1.5, (255, 0, 255), 2)
 
     @staticmethod
-    def send_mag(msg: str, bot: Union[bool, telebot.TeleBot] = False, chat_id: Union[bool, int] = False) -> None:
+    def send_mag(msg: str, bot: Union[bool, telebot.TeleBot] = False, chat_id: Union[bool, int] = False,
+                 coalesce_key: Optional[str] = None) -> None:
+        """
+        :param coalesce_key: passed only when set, bot is MessageQueue then (plain TeleBot doesn't take it)
+        """
         if bot and chat_id:
-            bot.send_message(chat_id, msg)
+            if coalesce_key is None:
+                bot.send_message(chat_id, msg)
+            else:
+                bot.send_message(chat_id, msg, coalesce_key=coalesce_key)
+
+    def _own_frames(self, stop_event: Optional[threading.Event]) -> Iterator[Tuple[np.ndarray, float, np.ndarray]]:
+        """
+        Newest frames of own camera with face boxes, frames captured while consumer was busy are skipped
+        :return: (frame, capture timestamp, (n, 4) boxes), ends when camera stops or stop_event is set
+        """
+        sampler = PresenceSampler(policy=self.policy)
+        grabber = FrameGrabber(cap=self.cap)
+        grabber.start()
+        frame, seq = None, 0
+        inference_time = stats.histogram("webcam_stage_seconds", stage="inference")
+
+        def detect(img: np.ndarray) -> np.ndarray:
+            with inference_time.time():
+                return self.get_boxes(img, model=self.policy.presence_model,
+                                      inference_width=self.policy.inference_width)
+
+        try:
+            while stop_event is None or not stop_event.is_set():
+                new_frame, seq, frame_time = grabber.read(frame, last_seq=seq, timeout=1.0)
+                if new_frame is None:
+                    if grabber.running:
+                        continue
+                    return
+                frame = new_frame
+                yield frame, frame_time, sampler.update(frame, frame_time, detect)
+        finally:
+            grabber.stop()
+            self.cap.release()
+
+    def _shared_frames(self, stop_event: Optional[threading.Event]) -> Iterator[Tuple[np.ndarray, float, np.ndarray]]:
+        """
+        Same as _own_frames but frames and detection come from CameraHub, so any number of schedules
+        costs one capture + one inference per frame
+        """
+        # imported here, CameraHub itself is built on top of this module
+        from MocneBoty.CameraHub import camera_hub
+
+        camera = camera_hub.subscribe(self.device_id, self.policy, capture_format=self.capture_format)
+        frame, seq = None, 0
+        try:
+            while stop_event is None or not stop_event.is_set():
+                new_frame, seq, frame_time, boxes = camera.get(frame, last_seq=seq, timeout=1.0)
+                if new_frame is None:
+                    if camera.running:
+                        continue
+                    return
+                frame = new_frame
+                yield frame, frame_time, boxes
+        finally:
+            camera_hub.unsubscribe(camera)
+
+    def request_snapshot(self, callback: Callable[[bytes], None]) -> None:
+        """
+        callback gets jpeg of the next frame (with overlays), it's called from the thread running run()
+        so it shouldn't block (e.g. MessageQueue.send_photo)
+        """
+        self._snapshot_requests.append(callback)
 
-    def run(self, bot: Union[bool, telebot.TeleBot] = False, chat_id: Union[bool, int] = False) -> None:
+    def run(self, bot: Union[bool, telebot.TeleBot] = False, chat_id: Union[bool, int] = False,
+            stop_event: Optional[threading.Event] = None, status_key: Optional[str] = None,
+            state: States = States.WORK, repeat_count: int = 0,
+            on_transition: Optional[Callable[[States, int], None]] = None,
+            presence: Optional[PresenceRecorder] = None) -> None:
+        """
+        :param stop_event: when set loop exits (used by /stopThread)
+        :param status_key: coalesce key for work/break messages, see MessageQueue
+        :param state: phase to start with, together with repeat_count lets restored schedule continue
+        :param repeat_count:
+        :param on_transition: called with new (state, repeat_count) after every work/break switch
+        :param presence: gets presence of every frame (/report), closing it is up to the caller
+        """
         last_time = 0
         start_time = time()
         current_time = 0
-        state = States.WORK
-        repeat_count = 0
-
-        self.send_mag(bot=bot, chat_id=chat_id, msg=f"Time for work")
-        while self.cap.isOpened() and repeat_count < self.repeat or not self.repeat:
-            success, frame = self.cap.read()
-            if not success:
-                print("Leaving...")
-                break
-
-            faces = self.get_lms(frame=frame)
-            if faces or state == States.BREAK:
-                current_time = int((time() - start_time) + last_time)
-                for face in faces:
-                    self.draw_face_rect(frame=frame, face_lm_list=face)
-            else:
-                if current_time:
-                    last_time = current_time
-                    current_time = 0
-                start_time = time()
-
-            if state == States.WORK:
-                if current_time > self.work_time:
-                    state = States.BREAK
-                    last_time = 0
-                    start_time = time()
-                    current_time = 0
-
-                    self.send_mag(bot=bot, chat_id=chat_id, msg=f"It's time for a break {repeat_count+1}/{self.repeat}!")
-            else:
-                if current_time > self.break_time:
-                    state = States.WORK
-                    last_time = 0
-                    start_time = time()
-                    current_time = 0
-                    if self.repeat:
-                        repeat_count += 1
-
-                    if repeat_count < self.repeat or not self.repeat:
-                        self.send_mag(bot=bot, chat_id=chat_id, msg=f"Time for work {repeat_count+1}/{self.repeat}")
-
-            self.display_info(frame=frame,
-                              current_time=current_time if current_time else last_time,
-                              state=state,
-                              repeat=repeat_count)
-            cv2.imshow("res", frame)
-            key = cv2.waitKey(1)
-            if key == 27:
-                break
-        self.cap.release()
-        cv2.destroyAllWindows()
+        last_preview = float("-inf")
+        frames = self._shared_frames(stop_event) if self.shared else self._own_frames(stop_event)
+        # capture and inference are measured where they happen (FrameGrabber, detect)
+        frame_wait = stats.histogram("webcam_stage_seconds", stage="frame_wait")
+        draw_time = stats.histogram("webcam_stage_seconds", stage="draw")
+        display_time = stats.histogram("webcam_stage_seconds", stage="display")
+
+        # camera (or hub subscription) and window are released even if sending or drawing fails
+        try:
+            self.send_mag(bot=bot, chat_id=chat_id, msg=f"Time for work" if state == States.WORK else f"Break time")
+            while repeat_count < self.repeat or not self.repeat:
+                with frame_wait.time():
+                    item = next(frames, None)
+                if item is None:
+                    if stop_event is None or not stop_event.is_set():
+                        print("Leaving...")
+                    break
+                frame, frame_time, faces = item
+                if presence is not None:
+                    presence.record(frame_time, present=len(faces) > 0, working=state == States.WORK)
+
+                # all timing uses capture time of the frame, not the time processing finished
+                if len(faces) or state == States.BREAK:
+                    current_time = int((frame_time - start_time) + last_time)
+                else:
+                    if current_time:
+                        last_time = current_time
+                        current_time = 0
+                    start_time = frame_time
+
+                if state == States.WORK:
+                    if current_time > self.work_time:
+                        state = States.BREAK
+                        last_time = 0
+                        start_time = frame_time
+                        current_time = 0
+
+                        self.send_mag(bot=bot, chat_id=chat_id,
+                                      msg=f"It's time for a break {repeat_count+1}/{self.repeat}!",
+                                      coalesce_key=status_key)
+                        if on_transition:
+                            on_transition(state, repeat_count)
+                else:
+                    if current_time > self.break_time:
+                        state = States.WORK
+                        last_time = 0
+                        start_time = frame_time
+                        current_time = 0
+                        if self.repeat:
+                            repeat_count += 1
+
+                        if repeat_count < self.repeat or not self.repeat:
+                            self.send_mag(bot=bot, chat_id=chat_id, msg=f"Time for work {repeat_count+1}/{self.repeat}",
+                                          coalesce_key=status_key)
+                        if on_transition:
+                            on_transition(state, repeat_count)
+
+                show = not self.headless and (not self.preview_fps or frame_time - last_preview >= 1 / self.preview_fps)
+                if not show and not self._snapshot_requests:
+                    continue
+
+                with draw_time.time():
+                    for face in faces:
+                        self.draw_box(frame=frame, box=face)
+                    self.display_info(frame=frame,
+                                      current_time=current_time if current_time else last_time,
+                                      state=state,
+                                      repeat=repeat_count)
+                if self._snapshot_requests:
+                    success, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
+                    while self._snapshot_requests:
+                        callback = self._snapshot_requests.popleft()
+                        if success:
+                            callback(jpeg.tobytes())
+                if show:
+                    last_preview = frame_time
+                    with display_time.time():
+                        cv2.imshow("res", frame)
+                        key = cv2.waitKey(1)
+                    if key == 27:
+                        break
+        finally:
+            frames.close()
+            if not self.headless:
+                cv2.destroyAllWindows()
 
 
 if __name__ == '__main__':
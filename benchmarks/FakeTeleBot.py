@@ -0,0 +1,126 @@
+from dataclasses import dataclass, field
+from time import monotonic, sleep
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import itertools
+import random
+import threading
+from telebot.apihelper import ApiTelegramException
+
+
+@dataclass
+class SentMessage:
+    chat_id: int
+    text: str
+    timestamp: float  # monotonic
+    kwargs: Dict[str, Any]
+
+
+@dataclass
+class FakeTeleBot:
+    """
+    Local stand-in for telebot.TeleBot, records what would be sent and can pretend to be slow or rate limited
+    """
+    token: str = ""
+    latency: float = 0  # seconds every api call takes
+    rate_limit_prob: float = 0  # probability that send_message fails with 429
+    retry_after: int = 1
+    clock: Callable[[], float] = monotonic
+    sent: List[SentMessage] = field(default_factory=list)
+    rate_limited: int = 0
+    _message_handlers: List[Tuple[List[str], Callable]] = field(default_factory=list)
+    _callback_handlers: List[Tuple[Callable, Callable]] = field(default_factory=list)
+    _message_ids: itertools.count = field(default_factory=lambda: itertools.count(1))
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def _api_call(self) -> None:
+        if self.latency:
+            sleep(self.latency)
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> SimpleNamespace:
+        self._api_call()
+        if self.rate_limit_prob and random.random() < self.rate_limit_prob:
+            with self._lock:
+                self.rate_limited += 1
+            raise ApiTelegramException("sendMessage", None, {
+                "ok": False, "error_code": 429, "description": "Too Many Requests",
+                "parameters": {"retry_after": self.retry_after}
+            })
+        with self._lock:
+            self.sent.append(SentMessage(chat_id=chat_id, text=text, timestamp=self.clock(), kwargs=kwargs))
+        return SimpleNamespace(message_id=next(self._message_ids), chat=SimpleNamespace(id=chat_id), text=text)
+
+    def send_photo(self, chat_id: int, photo: Any, **kwargs) -> SimpleNamespace:
+        return self.send_message(chat_id, "<photo>", photo=photo, **kwargs)
+
+    def edit_message_text(self, text: str, chat_id: int, message_id: int, **kwargs) -> None:
+        self._api_call()
+        with self._lock:
+            self.sent.append(SentMessage(chat_id=chat_id, text=text, timestamp=self.clock(),
+                                         kwargs=dict(kwargs, message_id=message_id)))
+
+    def message_handler(self, commands: Optional[List[str]] = None, **kwargs) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            self._message_handlers.append((commands or [], func))
+            return func
+        return decorator
+
+    def callback_query_handler(self, func: Callable, **kwargs) -> Callable:
+        def decorator(handler: Callable) -> Callable:
+            self._callback_handlers.append((func, handler))
+            return handler
+        return decorator
+
+    def polling(self, *args, **kwargs) -> None:
+        pass
+
+    def set_webhook(self, *args, **kwargs) -> bool:
+        return True
+
+    def remove_webhook(self) -> bool:
+        return True
+
+    @staticmethod
+    def make_message(text: str, chat_id: int) -> SimpleNamespace:
+        return SimpleNamespace(text=text, chat=SimpleNamespace(id=chat_id), message_id=0)
+
+    def _handle_message(self, message: Any) -> float:
+        command = message.text.split()[0].lstrip("/")
+        for commands, handler in self._message_handlers:
+            if command in commands:
+                start = monotonic()
+                handler(message)
+                return monotonic() - start
+        raise KeyError(f"No handler for /{command}")
+
+    def _handle_callback(self, callback: Any) -> float:
+        for func, handler in self._callback_handlers:
+            if func(callback):
+                start = monotonic()
+                handler(callback)
+                return monotonic() - start
+        raise KeyError(f"No callback handler for {callback.data}")
+
+    def dispatch(self, text: str, chat_id: int) -> float:
+        """
+        Runs handler of the command like polling would
+        :return: time the handler took (seconds)
+        """
+        return self._handle_message(self.make_message(text, chat_id))
+
+    def dispatch_callback(self, data: str, chat_id: int) -> float:
+        return self._handle_callback(SimpleNamespace(data=data, message=self.make_message("", chat_id)))
+
+    def process_new_updates(self, updates: List[Any]) -> None:
+        """
+        Same entry point webhook mode uses with the real TeleBot
+        """
+        for update in updates:
+            if getattr(update, "message", None) is not None:
+                self._handle_message(update.message)
+            elif getattr(update, "callback_query", None) is not None:
+                self._handle_callback(update.callback_query)
+
+    def messages_for(self, chat_id: int) -> List[SentMessage]:
+        with self._lock:
+            return [msg for msg in self.sent if msg.chat_id == chat_id]
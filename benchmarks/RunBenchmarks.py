@@ -0,0 +1,416 @@
+"""
+Offline benchmarks, no telegram connection or camera needed:
+
+    python -m MocneBoty.benchmarks.RunBenchmarks --out results.json
+    python -m MocneBoty.benchmarks.RunBenchmarks --only jitter handlers --counts 1 100
+    python -m MocneBoty.benchmarks.RunBenchmarks --video recorded.mp4  # adds face detection fps
+
+Everything is printed as one json, so results of two commits can be diffed
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from tempfile import TemporaryDirectory
+from time import monotonic, process_time, sleep, time
+from typing import Any, Callable, Dict, List, Optional
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from MocneBoty.MessageQueue import MessageQueue
+from MocneBoty.PresenceLog import PresenceRecorder, PresenceStore, format_report
+from MocneBoty.Scheduler import TimerScheduler
+from MocneBoty.TgBot import TelegramBot
+from MocneBoty.benchmarks.FakeTeleBot import FakeTeleBot
+from MocneBoty.benchmarks.SimClock import SimClock
+
+
+# runs in a fresh interpreter, imports of the parent process would hide the cost
+STARTUP_SCRIPT = """
+import json, resource, sys
+from time import perf_counter
+start = perf_counter()
+from MocneBoty.TgBot import TelegramBot
+TelegramBot(bot_token="", store_path="", presence_path="")
+ready = perf_counter()
+rss_ready = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+vision_loaded = "cv2" in sys.modules or "mediapipe" in sys.modules
+import MocneBoty.WorkScheduleWebcam
+print(json.dumps({"ready_seconds": ready - start, "ready_max_rss_kb": rss_ready,
+                  "vision_loaded_at_start": vision_loaded, "vision_import_seconds": perf_counter() - ready,
+                  "with_vision_max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+"""
+
+
+def summarize(values: List[float], scale: float = 1000) -> Dict[str, float]:
+    """
+    :param scale: 1000 = values in seconds are reported in ms
+    """
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def percentile(p: float) -> float:
+        return values[min(len(values) - 1, int(p * len(values)))] * scale
+
+    return {"count": len(values), "mean": sum(values) / len(values) * scale, "p50": percentile(0.5),
+            "p99": percentile(0.99), "max": values[-1] * scale}
+
+
+def make_bot(client: FakeTeleBot, **kwargs) -> TelegramBot:
+    # nothing is persisted, benchmarks shouldn't leave schedules.db behind (or read the real one)
+    return TelegramBot(bot_token="", store_path="", presence_path="", client=client, **kwargs)
+
+
+def wait_until(condition: Callable[[], bool], timeout: float) -> bool:
+    end = monotonic() + timeout
+    while not condition():
+        if monotonic() > end:
+            return False
+        sleep(0.05)
+    return True
+
+
+def bench_idle_cpu(schedules: int, seconds: float) -> Dict[str, Any]:
+    """
+    CPU burned by schedules that just wait (long work phase), should be ~0 and not grow with their number
+    """
+    tg = make_bot(FakeTeleBot())
+    tg.outbox = FakeTeleBot()
+    for ind in range(schedules):
+        tg.create_thread(tg.regular_schedule, work_time=3600, break_time=600, repeat=1, chat_id=ind,
+                         task_name="Regular", threaded=False)
+
+    cpu_start, wall_start = process_time(), monotonic()
+    sleep(seconds)
+    cpu, wall = process_time() - cpu_start, monotonic() - wall_start
+    tg.scheduler.stop()
+    return {"schedules": schedules, "seconds": wall, "cpu_seconds": cpu,
+            "cpu_us_per_schedule_per_second": cpu / wall / max(schedules, 1) * 1e6}
+
+
+def bench_jitter(schedules: int, work_time: int = 1, break_time: int = 1) -> Dict[str, Any]:
+    """
+    Real clock, how late work/break transitions are sent compared to when they should be
+    """
+    tg = make_bot(FakeTeleBot())
+    # recording outbox, transition time = time message was handed over (rate limits are a separate thing)
+    tg.outbox = FakeTeleBot()
+    create_start = monotonic()
+    for ind in range(schedules):
+        tg.create_thread(tg.regular_schedule, work_time=work_time, break_time=break_time, repeat=1, chat_id=ind,
+                         task_name="Regular", threaded=False)
+    create_time = monotonic() - create_start
+
+    finished = wait_until(lambda: not tg.threads_status, timeout=work_time + break_time + 30 + schedules / 1000)
+    tg.scheduler.stop()
+
+    started: Dict[int, float] = {}
+    lateness: List[float] = []
+    for msg in tg.outbox.sent:
+        if msg.text.startswith("Let's start"):
+            started[msg.chat_id] = msg.timestamp
+        elif "work finished" in msg.text:
+            lateness.append(msg.timestamp - started[msg.chat_id] - work_time)
+        elif "has been finished" in msg.text:
+            lateness.append(msg.timestamp - started[msg.chat_id] - work_time - break_time)
+    return {"schedules": schedules, "finished": finished, "create_seconds": create_time,
+            "lateness_ms": summarize(lateness)}
+
+
+def bench_simulated(schedules: int, hours: float, step: float = 1.0) -> Dict[str, Any]:
+    """
+    Simulated clock, whole day of transitions in seconds of wall time, shows scheduler/registry overhead alone
+    """
+    clock = SimClock()
+    tg = make_bot(FakeTeleBot(clock=clock.monotonic), scheduler=TimerScheduler(clock=clock.monotonic))
+    tg.outbox = FakeTeleBot(clock=clock.monotonic)
+    for ind in range(schedules):
+        entry = tg.register_thread(work_time=25 * 60 + ind % 60, break_time=5 * 60, chat_id=ind,
+                                   task_name="Regular", repeat=0)
+        # called directly, scheduler thread must not run next to run_pending
+        tg.regular_schedule(entry.thread_id, entry.data.work_time, entry.data.break_time, entry.data.repeat,
+                            entry.chat_id)
+
+    fired = 0
+    wall_start = monotonic()
+    while clock.now < hours * 3600:
+        clock.advance(step)
+        fired += tg.scheduler.run_pending()
+    wall = monotonic() - wall_start
+    return {"schedules": schedules, "simulated_hours": hours, "transitions": fired, "wall_seconds": wall,
+            "transitions_per_second": fired / wall if wall else 0}
+
+
+def bench_handlers(iterations: int, api_latency: float) -> Dict[str, Any]:
+    """
+    Time from update to handler return, api_latency simulates slow telegram on replies sent from handlers
+    """
+    client = FakeTeleBot(latency=api_latency)
+    tg = make_bot(client)
+    tg.outbox = FakeTeleBot()
+    tg.setup_handlers()
+
+    timings: Dict[str, List[float]] = {"start": [], "regular": [], "listThreads": [], "stopThread": [],
+                                       "callback": []}
+    for ind in range(iterations):
+        timings["start"].append(client.dispatch("/start", ind))
+        timings["regular"].append(client.dispatch("/regular 3600 600 1", ind))
+        timings["listThreads"].append(client.dispatch("/listThreads", ind))
+        timings["callback"].append(client.dispatch_callback("list_threads", ind))
+        thread_id = tg.chat_threads(ind)[0].thread_id
+        timings["stopThread"].append(client.dispatch(f"/stopThread {thread_id}", ind))
+    tg.scheduler.stop()
+    return {"iterations": iterations, "api_latency_ms": api_latency * 1000,
+            "latency_ms": {command: summarize(values) for command, values in timings.items()}}
+
+
+def bench_message_queue(chats: int, per_chat: int, api_latency: float, rate_limit_prob: float) -> Dict[str, Any]:
+    """
+    Outbox against fake api that is slow and sometimes answers 429, telegram limits are lifted so the queue
+    itself is measured
+    """
+    client = FakeTeleBot(latency=api_latency, rate_limit_prob=rate_limit_prob, retry_after=1)
+    outbox = MessageQueue(bot=client, global_rate=1e6, global_burst=1e6, chat_rate=1e6, chat_burst=1e6)
+    outbox.start()
+    start = monotonic()
+    for ind in range(per_chat):
+        for chat_id in range(chats):
+            outbox.send_message(chat_id, f"message {ind}")
+    drained = wait_until(lambda: outbox.depth() == 0, timeout=60 + chats * per_chat * api_latency)
+    wall = monotonic() - start
+    outbox.stop()
+    return {"messages": chats * per_chat, "drained": drained, "wall_seconds": wall,
+            "rate_limited": client.rate_limited, "stats": outbox.stats()}
+
+
+def bench_outbox_chats(chats: int, seconds: float) -> Dict[str, Any]:
+    """
+    One message for each of many chats with default per chat limits. Drained chats stay in the queue until
+    their bucket refills, so this is where picking the next chat has to be cheap
+    """
+    client = FakeTeleBot()
+    outbox = MessageQueue(bot=client, global_rate=1e6, global_burst=1e6)
+    outbox.start()
+    start = monotonic()
+    for chat_id in range(chats):
+        outbox.send_message(chat_id, "message")
+    drained = wait_until(lambda: outbox.depth() == 0, timeout=120)
+    drain_wall = monotonic() - start
+    outbox.stop()
+
+    # telegram limits: ~30 msg/s go out, the rest waits, waiting shouldn't burn cpu
+    client = FakeTeleBot()
+    outbox = MessageQueue(bot=client)
+    outbox.start()
+    for chat_id in range(chats):
+        outbox.send_message(chat_id, "message")
+    cpu_start = process_time()
+    sleep(seconds)
+    cpu = process_time() - cpu_start
+    outbox.stop()
+    return {"chats": chats, "drained": drained, "drain_wall_seconds": drain_wall,
+            "limited_sent": len(client.sent), "limited_seconds": seconds, "limited_cpu_seconds": cpu}
+
+
+def bench_webhook(chats: int, per_chat: int, api_latency: float, workers: int, port: int) -> Dict[str, Any]:
+    """
+    Updates posted to local webhook server like telegram does, every handler answers through slow fake api.
+    Replies of each chat have to come back in the order updates were sent
+    """
+    client = FakeTeleBot(latency=api_latency)
+    tg = make_bot(client, webhook_url=f"http://127.0.0.1:{port}/webhook", webhook_host="127.0.0.1",
+                  webhook_port=port, update_workers=workers, update_queue=chats * per_chat)
+    tg.setup_handlers()
+    server = tg.start_webhook()
+    url = f"http://127.0.0.1:{port}/webhook"
+
+    def post_chat(chat_id: int) -> int:
+        rejected = 0
+        for seq in range(per_chat):
+            # /stopThread of not existing thread, reply contains seq so order can be checked
+            body = json.dumps({"update_id": chat_id * per_chat + seq, "message": {
+                "message_id": seq, "date": 0, "text": f"/stopThread {seq}",
+                "chat": {"id": chat_id, "type": "private"}}}).encode()
+            while True:
+                try:
+                    urlopen(Request(url, data=body, headers={"Content-Type": "application/json"})).read()
+                    break
+                except HTTPError as e:
+                    if e.code != 429:
+                        raise
+                    rejected += 1
+                    sleep(0.05)
+        return rejected
+
+    start = monotonic()
+    with ThreadPoolExecutor(max_workers=min(chats, 32)) as pool:
+        rejected = sum(pool.map(post_chat, range(chats)))
+    server.stop(timeout=60)
+    wall = monotonic() - start
+    tg.scheduler.stop()
+
+    in_order = all([int(msg.text.split()[1]) for msg in client.messages_for(chat_id)] == list(range(per_chat))
+                   for chat_id in range(chats))
+    return {"updates": chats * per_chat, "workers": workers, "api_latency_ms": api_latency * 1000,
+            "wall_seconds": wall, "updates_per_second": chats * per_chat / wall, "rejected_429": rejected,
+            "replies": len(client.sent), "per_chat_order_kept": in_order}
+
+
+def bench_startup(runs: int) -> Dict[str, Any]:
+    """
+    Cold start of text only bot (import + TelegramBot()), vision stack is imported afterwards to show what it costs
+    """
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], capture_output=True, text=True, check=True)
+        results.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    return {"runs": runs, "ready_ms": summarize([result["ready_seconds"] for result in results]),
+            "vision_import_ms": summarize([result["vision_import_seconds"] for result in results]),
+            "vision_loaded_at_start": any(result["vision_loaded_at_start"] for result in results),
+            "ready_max_rss_kb": max(result["ready_max_rss_kb"] for result in results),
+            "with_vision_max_rss_kb": max(result["with_vision_max_rss_kb"] for result in results)}
+
+
+def bench_presence(days: int, frames: int = 100000) -> Dict[str, Any]:
+    """
+    Per frame cost of presence recording and /report over days of history (8h session a day, 1 frame per 5s
+    with presence changing every few minutes)
+    """
+    with TemporaryDirectory() as tmp:
+        store = PresenceStore(db_path=os.path.join(tmp, "presence.db"))
+        recorder = PresenceRecorder(store=None, chat_id=0, schedule_id=0)
+        start = monotonic()
+        for ind in range(frames):
+            recorder.record(ind * 0.1, present=ind % 3000 < 2500, working=ind % 18000 < 15000)
+        record_time = monotonic() - start
+
+        first_day = date.today() - timedelta(days=days - 1)
+        write_start = monotonic()
+        for day in range(days):
+            recorder = PresenceRecorder(store=store, chat_id=1, schedule_id=day)
+            t = time() - (days - 1 - day) * 86400 - 8 * 3600
+            for ind in range(8 * 3600 // 5):
+                recorder.record(t + ind * 5, present=ind % 60 < 50, working=ind % 360 < 300)
+            recorder.close()
+        store.flush()
+        write_time = monotonic() - write_start
+
+        timings = {"day": [], "week": [], "all": []}
+        for _ in range(20):
+            for name, first in (("day", date.today()), ("week", date.today() - timedelta(days=6)), ("all", first_day)):
+                query_start = monotonic()
+                format_report("Report", store.days(1, first.isoformat(), date.today().isoformat()),
+                              per_day=name == "week")
+                timings[name].append(monotonic() - query_start)
+        store.stop()
+        return {"frames": frames, "record_us_per_frame": record_time / frames * 1e6, "history_days": days,
+                "history_write_seconds": write_time, "report_ms": {name: summarize(values)
+                                                                   for name, values in timings.items()}}
+
+
+def bench_face_detection(video: str, frames: int) -> Dict[str, Any]:
+    """
+    get_lms/get_boxes fps on recorded video, same frames for every model
+    """
+    # vision stack is imported only when it's actually measured
+    from MocneBoty.WorkScheduleWebcam import DetectionPolicy, PresenceSampler, WorkScheduleWebcam
+    from MocneBoty.benchmarks.VideoFileSource import VideoFileSource
+
+    wsw = WorkScheduleWebcam(max_faces=1, device_id=0, work_time=0, break_time=0, repeat=1,
+                             capture=VideoFileSource(video, realtime=False, loop=True))
+    images = []
+    while len(images) < frames:
+        success, img = wsw.cap.read()
+        if not success:
+            break
+        images.append(img)
+    wsw.cap.release()
+    if not images:
+        return {"skipped": f"no frames in {video}"}
+
+    def roi_tracking(model: str) -> Callable:
+        # every frame inferred, only the roi part of policy is measured
+        sampler = PresenceSampler(policy=DetectionPolicy(presence_model=model, inference_width=320, roi_tracking=True))
+        return lambda img: sampler.update(img, monotonic(), lambda crop: wsw.get_boxes(crop, model=model,
+                                                                                      inference_width=320))
+
+    results = {"frames": len(images), "resolution": list(images[0].shape[:2])}
+    for name, func in (("get_lms", lambda img: wsw.get_lms(img)),
+                       ("get_lms_320", lambda img: wsw.get_lms(img, inference_width=320)),
+                       ("get_boxes_mesh", lambda img: wsw.get_boxes(img, model="mesh")),
+                       ("get_boxes_detection", lambda img: wsw.get_boxes(img, model="detection")),
+                       ("get_boxes_detection_320", lambda img: wsw.get_boxes(img, model="detection",
+                                                                             inference_width=320)),
+                       ("roi_detection_320", roi_tracking("detection"))):
+        func(images[0])  # first call builds the graph
+        timings = []
+        for img in images:
+            start = monotonic()
+            func(img)
+            timings.append(monotonic() - start)
+        results[name] = {"fps": len(timings) / sum(timings), "latency_ms": summarize(timings)}
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description="WorkScheduleTelegramBot offline benchmarks")
+    parser.add_argument("--only", nargs="*", default=None,
+                        choices=["startup", "idle", "jitter", "simulated", "handlers", "outbox", "webhook", "presence",
+                                 "faces"])
+    parser.add_argument("--counts", nargs="*", type=int, default=[1, 100, 10000],
+                        help="numbers of schedules for idle/jitter/simulated")
+    parser.add_argument("--idle-seconds", type=float, default=5)
+    parser.add_argument("--simulated-hours", type=float, default=8)
+    parser.add_argument("--iterations", type=int, default=200, help="handler benchmark iterations")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated api latency in seconds")
+    parser.add_argument("--rate-limit-prob", type=float, default=0.01, help="chance of 429 in outbox benchmark")
+    parser.add_argument("--webhook-port", type=int, default=8499)
+    parser.add_argument("--presence-days", type=int, default=180, help="days of presence history for /report")
+    parser.add_argument("--video", default="", help="recorded video for face detection benchmark")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--out", default="", help="json file (stdout if not given)")
+    args = parser.parse_args(argv)
+    selected = set(args.only or ["startup", "idle", "jitter", "simulated", "handlers", "outbox", "webhook", "presence",
+                                 "faces"])
+
+    results: Dict[str, Any] = {"python": sys.version.split()[0]}
+    if "startup" in selected:
+        results["startup"] = bench_startup(runs=5)
+    if "idle" in selected:
+        results["idle_cpu"] = [bench_idle_cpu(count, args.idle_seconds) for count in args.counts]
+    if "jitter" in selected:
+        results["jitter"] = [bench_jitter(count) for count in args.counts]
+    if "simulated" in selected:
+        results["simulated"] = [bench_simulated(count, args.simulated_hours) for count in args.counts]
+    if "handlers" in selected:
+        results["handlers"] = bench_handlers(args.iterations, args.api_latency)
+    if "outbox" in selected:
+        results["outbox"] = bench_message_queue(chats=100, per_chat=10, api_latency=args.api_latency,
+                                                rate_limit_prob=args.rate_limit_prob)
+        results["outbox_chats"] = [bench_outbox_chats(chats, args.idle_seconds) for chats in (1000, 10000)]
+    if "webhook" in selected:
+        # 1 worker = what polling does (one update after another)
+        results["webhook"] = [bench_webhook(chats=20, per_chat=10, api_latency=max(args.api_latency, 0.02),
+                                            workers=workers, port=args.webhook_port + ind)
+                              for ind, workers in enumerate((1, 8))]
+    if "presence" in selected:
+        results["presence"] = bench_presence(args.presence_days)
+    if "faces" in selected:
+        results["faces"] = bench_face_detection(args.video, args.frames) if args.video else \
+            {"skipped": "no --video given"}
+
+    output = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return results
+
+
+if __name__ == '__main__':
+    main()
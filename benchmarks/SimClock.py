@@ -0,0 +1,17 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class SimClock:
+    """
+    Clock that moves only when told to, pass clock.monotonic as TimerScheduler clock and drive it
+    with advance() + scheduler.run_pending()
+    """
+    now: float = 0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> float:
+        self.now += seconds
+        return self.now
@@ -0,0 +1,60 @@
+from dataclasses import dataclass, field
+from time import monotonic, sleep
+from typing import Optional, Tuple
+import numpy as np
+import cv2
+
+
+@dataclass
+class VideoFileSource:
+    """
+    cv2.VideoCapture look-alike reading a recorded video, can be passed as WorkScheduleWebcam(capture=...)
+    """
+    path: str
+    realtime: bool = True  # deliver frames at file fps like a camera would, otherwise as fast as possible
+    loop: bool = True
+    _cap: cv2.VideoCapture = field(init=False)
+    _frame_interval: float = field(init=False, default=0)
+    _next_frame_time: float = field(init=False, default=0)
+
+    def __post_init__(self) -> None:
+        self._cap = cv2.VideoCapture(self.path)
+        fps = self._cap.get(cv2.CAP_PROP_FPS) or 30
+        self._frame_interval = 1 / fps
+
+    def isOpened(self) -> bool:
+        return self._cap.isOpened()
+
+    def _pace(self) -> None:
+        if not self.realtime:
+            return
+        now = monotonic()
+        if self._next_frame_time > now:
+            sleep(self._next_frame_time - now)
+        self._next_frame_time = max(now, self._next_frame_time) + self._frame_interval
+
+    def grab(self) -> bool:
+        self._pace()
+        if self._cap.grab():
+            return True
+        if not self.loop:
+            return False
+        self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return self._cap.grab()
+
+    def retrieve(self, image: Optional[np.ndarray] = None) -> Tuple[bool, Optional[np.ndarray]]:
+        return self._cap.retrieve(image)
+
+    def read(self, image: Optional[np.ndarray] = None) -> Tuple[bool, Optional[np.ndarray]]:
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def set(self, prop_id: int, value: float) -> bool:
+        return self._cap.set(prop_id, value)
+
+    def get(self, prop_id: int) -> float:
+        return self._cap.get(prop_id)
+
+    def release(self) -> None:
+        self._cap.release()